@@ -7,6 +7,14 @@
 #
 archs		= list(default=list())
 
+# Number of architectures to build in parallel. Each architecture is built
+# in a separate process and its output is prefixed with the architecture
+# name. A failed architecture does not interrupt the others.
+#
+# Can be set via --jobs <JOBS> command line argument.
+#
+jobs		= integer(min=1, default=1)
+
 # The Debian mirror. config['apt']['sources']['debian']['uri'] and
 # config['chroot']['bootstrap']['uri'] default to this ($mirror). Either that
 # or comment this out and set those configuration items independently.
@@ -70,6 +78,26 @@ proxy		= string(default='')
 #
 src		= boolean(default=False)
 
+# Download the archives of the package profile in the background while the
+# chroot is initialised, instead of within the installation. apt is set up
+# and the package profile resolved before chroot initialisation, keys are
+# imported and keyring packages installed after it.
+#
+# Can be set via --apt-prefetch command line argument.
+#
+prefetch	= boolean(default=False)
+
+# Bulk installation mode. dpkg is configured with force-unsafe-io, so that
+# it does not fsync each unpacked file, and triggers are deferred to a
+# single dpkg --triggers-only pass after each installation. If eatmydata is
+# installed in the chroot (eg. via --chroot-include), libeatmydata is added
+# to /etc/ld.so.preload. All of these are removed when apt is finished with
+# the chroot.
+#
+# Can be set via --apt-bulk command line argument.
+#
+bulk		= boolean(default=False)
+
 # Verbosity level of class. Inherits the top level 'verbosity' mode.
 #
 # Can be set via --apt-quiet, --apt-verbose and --apt-debug command line
@@ -95,6 +123,57 @@ disable		= boolean(default=False)
 #
 server		= string(min=1, default='wwwkeys.eu.pgp.net')
 
+# Host side cache of downloaded package archives. It is shared by all
+# builds and architectures. Cached archives are linked into the chroot
+# before installation, after being verified against the checksums of the
+# Packages index, and newly downloaded archives are moved into the cache
+# afterwards. Entries unused for longer than maxage days are evicted, as are
+# the least recently used entries when the cache grows larger than maxsize
+# MB. A limit of 0 disables it.
+#
+# Can be enabled via --apt-cache, dir can be set via --apt-cache-dir <DIR>
+# command line arguments.
+#
+[[cache]]
+enable		= boolean(default=False)
+dir		= string(min=1, default='/var/cache/fll/archives')
+maxage		= integer(min=0, default=0)
+maxsize		= integer(min=0, default=8192)
+
+# Local partial mirror of the packages installed by a build. With mode
+# build, the archives of every package installed via apt are stored in dir
+# along with generated Packages and Release files. With mode use, apt
+# installs from that mirror only and the configured sources are written to
+# the chroot when the build is complete, so builds of the same profile are
+# reproducible and do not need the network. The bootstrap is not covered,
+# see the bootstrap cache in the [chroot] section.
+#
+# Can be set via --apt-mirror <MODE> and --apt-mirror-dir <DIR> command line
+# arguments.
+#
+[[mirror]]
+mode		= option('none', 'build', 'use', default='none')
+dir		= string(min=1, default='/var/cache/fll/mirror')
+
+# Download settings of apt. queuemode selects whether apt opens a download
+# queue per host or per access method (Acquire::Queue-Mode), parallel limits
+# the number of queues which download at once (Acquire::QueueHost::Limit),
+# pipeline sets the depth of HTTP pipelining (Acquire::http::Pipeline-Depth)
+# and retries the number of retries of a failed download (Acquire::Retries).
+# Options which are not set keep apt's defaults. The slowest downloads are
+# listed after each download run, to aid tuning against a mirror.
+#
+# Can be set via --apt-fetch-queuemode <MODE>, --apt-fetch-parallel <N>,
+# --apt-fetch-pipeline <DEPTH>, --apt-fetch-retries <N> and
+# --apt-fetch-slowest <N> command line arguments.
+#
+[[fetch]]
+queuemode	= option('host', 'access', default=None)
+parallel	= integer(min=1, default=None)
+pipeline	= integer(min=0, default=None)
+retries		= integer(min=0, default=None)
+slowest		= integer(min=0, default=5)
+
 # Each entry in the [apt][[conf]] section is an apt configuration
 # keyword=value pair.
 #
@@ -167,6 +246,33 @@ dir		= string(default='')
 # Packages to be installed
 packages	= list(default=list())
 
+# Names of package profiles to build as variants of the profile above. The
+# profile above is installed into a base chroot once. Each variant is then
+# installed into its own overlayfs layer on top of the base chroot and
+# compressed separately, with its name added to the output filenames.
+variants	= list(default=list())
+
+# Locales for which locale support packages of the profile's packages are
+# installed, as mapped by the locales-pkg-map data file (eg. en_US, de_DE).
+# Empty by default, so that no locale support packages are added.
+#
+# Can be set via --profile-locales <LOCALE>[ <LOCALE> ...] command line
+# argument.
+#
+locales		= list(default=list())
+
+# Cache of expanded package profiles. The package list of each profile and
+# architecture is stored in dir, keyed by the profile directory, and reused
+# until one of the lists it was expanded from, or any directory of the
+# profile directory, is modified.
+#
+# Can be enabled via --profile-cache, dir can be set via
+# --profile-cache-dir <DIR> command line arguments.
+#
+[[cache]]
+enable		= boolean(default=False)
+dir		= string(min=1, default='/var/cache/fll/profile')
+
 
 ##############################################################################
 # General options for fll.chroot.Chroot class.
@@ -190,11 +296,86 @@ quiet		= boolean(default=False)
 verbose		= boolean(default=False)
 debug		= boolean(default=False)
 
+# Additional files to divert and replace with a stub which denies execution
+# while the chroot is built, as is done for policy-rc.d, update-initramfs,
+# start-stop-daemon and others by default.
+#
+# Can be set via --chroot-diverts <FILE>[ <FILE> ...] command line argument.
+#
+diverts		= list(default=list())
+
+# Execute chrooted commands via a small shell helper which is started in
+# the chroot once and forks each command it is given, instead of forking
+# fll and chrooting for every command.
+#
+# Can be set via --chroot-server command line argument.
+#
+server		= boolean(default=False)
+
 # Hostname for the chroot.  Defaults to chroot
 #
 # Can be set via --hostname
 hostname       = string(min=1, default="chroot")
 
+# Hooks which are run for each of several items, such as update-initramfs
+# for each installed kernel. Up to jobs items are run in parallel, 0 for the
+# number of processors. With failfast no more items are started after one
+# has failed.
+#
+# Can be set via --hook-jobs <JOBS> and --hook-failfast command line
+# arguments.
+#
+[[hooks]]
+jobs		= integer(min=0, default=0)
+failfast	= boolean(default=False)
+
+# Generation of the man-db index at the end of the build. With sync mandb
+# runs to completion before the initramfs is generated, background runs it
+# alongside initramfs generation, skip leaves the index to be created on the
+# first boot. With cached the index is stored in dir, keyed by the set of
+# installed packages and architecture, and reused by later builds with an
+# identical package set. Entries unused for longer than maxage days are
+# evicted, as are the least recently used entries when the cache grows
+# larger than maxsize MB.
+#
+# Can be set via --mandb <MODE> and --mandb-cache-dir <DIR> command line
+# arguments.
+#
+[[mandb]]
+mode		= option('sync', 'background', 'cached', 'skip', default='sync')
+dir		= string(min=1, default='/var/cache/fll/mandb')
+maxage		= integer(min=0, default=14)
+maxsize		= integer(min=0, default=256)
+
+# Build the chroot in memory. A tmpfs of size MB is mounted at the root of
+# each architecture's chroot before bootstrap, if that much memory plus
+# reserve MB is available. Before packages are installed the tmpfs is grown
+# by the space apt requires plus reserve MB, or the chroot is moved to disk
+# if there is not enough memory. Compressed outputs within the chroot are
+# moved to --dir. Layered profile variants are built on disk on top of it.
+#
+# Can be set via --tmpfs, --tmpfs-size <MB> and --tmpfs-reserve <MB>
+# command line arguments.
+#
+[[tmpfs]]
+enable		= boolean(default=False)
+size		= integer(min=1, default=2048)
+reserve		= integer(min=0, default=1024)
+
+# Removal of the chroot. The chroot is renamed to a tombstone next to it and
+# then removed by jobs threads, 0 for the number of processors. In background
+# mode the tombstone is removed by a detached process and fll carries on at
+# once. A chroot which is a btrfs subvolume is deleted as such, unless rmtree
+# is set.
+#
+# Can be set via --nuke-mode <MODE>, --nuke-jobs <JOBS> and --nuke-rmtree
+# command line arguments.
+#
+[[nuke]]
+mode		= option('sync', 'background', default='sync')
+jobs		= integer(min=0, default=0)
+rmtree		= boolean(default=False)
+
 # Bootstrap utility and options.
 #
 # For every keyword=value pair below exists a command line argument:
@@ -208,6 +389,37 @@ flavour		= option('minimal', 'build', 'standard', default='minimal')
 include		= string(default='apt-utils,bzip2,gnupg,systemd-sysv,xz-utils')
 exclude		= string(default='init,sysvinit,sysvinit-core')
 
+# Cache of bootstrapped chroots. A freshly bootstrapped chroot is stored as
+# a compressed archive, keyed by the bootstrap options, architecture and the
+# date of the mirror's Release file. Later builds with identical parameters
+# unpack it instead of bootstrapping again. Entries unused for longer than
+# maxage days are evicted, as are the least recently used entries when the
+# cache grows larger than maxsize MB. A limit of 0 disables it.
+#
+# Can be enabled via --bootstrap-cache, dir can be set via
+# --bootstrap-cache-dir <DIR> command line arguments.
+#
+[[cache]]
+enable		= boolean(default=False)
+dir		= string(min=1, default='/var/cache/fll/bootstrap')
+maxage		= integer(min=0, default=14)
+maxsize		= integer(min=0, default=2048)
+
+# Build checkpoints. When enabled, each completed build stage (bootstrap,
+# init, apt, distro, deinit, compress) is recorded next to the chroot and
+# the chroot is kept if the build fails. A build with the same configuration
+# may then be resumed after the last completed stage. With snapshot=reflink
+# the chroot is also copied with cp --reflink=always (btrfs, xfs) after each
+# stage, and the copy is restored before resuming.
+#
+# Can be set via --checkpoint, --resume and --checkpoint-snapshot <MODE>
+# command line arguments. --resume implies --checkpoint.
+#
+[[checkpoint]]
+enable		= boolean(default=False)
+resume		= boolean(default=False)
+snapshot	= option('none', 'reflink', default='none')
+
 ##############################################################################
 # Each entry in this section is an environment variable keyword=value pair.
 #
@@ -253,6 +465,15 @@ quiet		= boolean(default=False)
 verbose		= boolean(default=False)
 debug		= boolean(default=False)
 
+# Find files of identical content in the chroot before compression, skipping
+# paths excluded from the compressed image. With report the bytes taken by
+# duplicates are listed, with the packages owning them. With hardlink the
+# duplicates below usr/ are also replaced by hardlinks, which makes tar and
+# mkfs outputs smaller. Files of etc/ and var/ are never hardlinked, as they
+# may be modified in place. Can be set with --dedup <MODE> command line
+# argument.
+dedup		= option('none', 'report', 'hardlink', default='none')
+
 # List of wrappers to apply to last output.  Only iso (or none) for now.
 wrap		= list(default=list('none'))
 
@@ -261,22 +482,53 @@ wrap		= list(default=list('none'))
 [[squashfs]]
 # squashfs filename, can be set with --squashfs-file command line argument
 file            = string(min=0, default='')
-# gzip, lzo or xz compressor
-compressor	= option('gzip', 'lzo', 'xz', default='gzip')
+# gzip, lzo, lz4, xz or zstd compressor
+compressor	= option('gzip', 'lzo', 'lz4', 'xz', 'zstd', default='gzip')
+# number of processors used by mksquashfs, 0 for all available
+processors	= integer(min=0, default=0)
+# block size (eg. 128K or 1M), empty for the mksquashfs default
+blocksize	= string(default='')
+# memory budget (eg. 512M or 2G), empty for the mksquashfs default
+mem		= string(default='')
+# compression level of gzip, lzo or zstd, 0 for the compressor default.
+# Any level > 0 selects high compression mode of lz4.
+level		= integer(min=0, default=0)
+# xz branch/call/jump filter (x86, arm, armthumb, arm64, powerpc, sparc,
+# ia64), auto to select it by architecture or none to disable it
+bcj		= string(min=1, default='auto')
+# build a delta image of the changes since the previous build instead of a
+# full image, written to the delta file. Changed and added paths are stored
+# and removed paths are stored as overlayfs whiteouts, so the delta can be
+# mounted as an overlay on top of the previous images. A manifest of path,
+# size, mtime and sha1 is kept next to file (or in manifest) to compare the
+# next build with. The first build, without a manifest, is a full image to
+# file. Can be set with --squashfs-delta <FILE> and --squashfs-manifest
+# <FILE> command line arguments.
+delta		= string(default='')
+manifest	= string(default='')
 
 # Tar compression options.
 #
 [[tar]]
 # tar filename, can be set with --tar-file command line argument
 file            = string(min=0, default='')
-# gz, bz, xz or pixz compressor
-compressor	= option('gz', 'bz', 'xz', 'pz', default='gz')
+# gz, bz, xz, pixz or zstd compressor
+compressor	= option('gz', 'bz', 'xz', 'pz', 'zstd', default='gz')
+# stream tar output through a parallel compressor (pigz, pbzip2, xz, pixz
+# or zstd) straight to the output file, can be set with --tar-stream
+stream		= boolean(default=False)
+# number of compressor threads when streaming, 0 for all available
+threads		= integer(min=0, default=0)
 
 # mkfs options
 #
 [[mkfs]]
 # hand set the filename
 file            = string(min=0, default='')
+# populate: mkfs -d fills an image sized from a scan of the chroot (needs
+#           e2fsprogs >= 1.43 on the build host), size and shrink are unused
+# rsync:    allocate size, loop mount, rsync the chroot into it and shrink
+engine		= option('populate', 'rsync', default='rsync')
 # just ext2, ext3, ext4 support (for now anyway)
 type           = option('ext2', 'ext3', 'ext4', default='ext2')
 # the size in MB to allocate (sparsely) for the initial filesystem
@@ -7,17 +7,24 @@ Copyright: Copyright (C) 2010 Kel Modderman <kel@otaku42.de>
 License:   GPL-2
 """
 
-from contextlib import nested
+from contextlib import contextmanager, nested
 from tempfile import NamedTemporaryFile
 
 import apt.cache
 import apt.package
 import apt_pkg
 import datetime
+import fcntl
+import gc
+import glob
 import os
 import shutil
 import subprocess
+import threading
+import time
+import fll.cache
 import fll.misc
+import fll.report
 
 
 class AptLibError(Exception):
@@ -27,6 +34,19 @@ class AptLibError(Exception):
     pass
 
 
+def archive_filename(version):
+    """Return the file name of the archive of an apt.package.Version object
+    as stored by apt in /var/cache/apt/archives/."""
+    def quote(string, bad):
+        return ''.join([c in bad + '%' and '%%%02x' % ord(c) or c
+                        for c in string])
+
+    return '%s_%s_%s.%s' % (quote(version.package.shortname, '_:'),
+                            quote(version.version, '_:'),
+                            quote(version.architecture, '_:.'),
+                            version.filename.rsplit('.', 1)[-1])
+
+
 class AptLib(object):
     """
     A class for preparing and using apt within a chroot.
@@ -35,8 +55,10 @@ class AptLib(object):
     --------------------------------------------------------------------------
     chroot - (fll.chroot.Chroot) fll.chroot.Chroot object
     config - (dict)              the 'apt' section of fll.config.Config object
+    key    - (bool)              import keys and install keyrings, else
+                                 key() must be called later
     """
-    def __init__(self, chroot=None, config={}):
+    def __init__(self, chroot=None, config={}, key=True):
         if chroot is None:
             raise AptLibError('must specify chroot=')
         if not config:
@@ -45,12 +67,18 @@ class AptLib(object):
         self.chroot = chroot
         self.config = config
         self.cache = None
-        self._progress = AptLibProgress(quiet=config['quiet'])
+        self._prefetch = None
+        self._prefetch_error = None
+        self._progress = AptLibProgress(quiet=config['quiet'],
+                                        slowest=config['fetch']['slowest'])
 
         self.sources_list(final_uri=False, src=config['src'])
         self._init_cache()
+        if config['bulk']:
+            self._bulk_init()
         self.update()
-        self.key(disable=config['key']['disable'])
+        if key:
+            self.key(disable=config['key']['disable'])
 
     def _init_cache(self):
         """Initialise apt in the chroot."""
@@ -66,6 +94,15 @@ class AptLib(object):
         for keyword, value in self.config['conf'].iteritems():
             apt_pkg.config.set(keyword, value)
 
+        # Set download concurrency, pipelining and retries.
+        fetch = self.config['fetch']
+        for keyword, option in (('Acquire::Queue-Mode', 'queuemode'),
+                                ('Acquire::QueueHost::Limit', 'parallel'),
+                                ('Acquire::http::Pipeline-Depth', 'pipeline'),
+                                ('Acquire::Retries', 'retries')):
+            if fetch[option] is not None:
+                apt_pkg.config.set(keyword, str(fetch[option]))
+
         # Avoid apt-listchanges / dpkg-preconfigure
         apt_pkg.config.clear("DPkg::Pre-Install-Pkgs")
 
@@ -76,8 +113,82 @@ class AptLib(object):
 
     def deinit(self):
         self.sources_list(final_uri=True, src=False)
+        if self.config['mirror']['mode'] == 'use':
+            self._mirror_forget()
+        if self.config['bulk']:
+            self._bulk_deinit()
         #self.clean()
 
+    _bulk_dpkg_cfg = '/etc/dpkg/dpkg.cfg.d/fll-bulk'
+    _bulk_preload = '/etc/ld.so.preload'
+
+    def _bulk_init(self):
+        """Prepare the chroot for bulk installation: dpkg does not fsync
+        unpacked files, triggers are deferred to a single pass after each
+        commit and, if libeatmydata is installed in the chroot, it is
+        preloaded by every chrooted process. Undone by _bulk_deinit()."""
+        cfg = self.chroot.chroot_path(self._bulk_dpkg_cfg)
+        if not os.path.isdir(os.path.dirname(cfg)):
+            os.makedirs(os.path.dirname(cfg))
+        with open(cfg, 'w') as fh:
+            print >>fh, 'force-unsafe-io'
+
+        apt_pkg.config.set('DPkg::NoTriggers', 'true')
+        apt_pkg.config.set('DPkg::ConfigurePending', 'false')
+        apt_pkg.config.set('DPkg::TriggersPending', 'false')
+
+        libs = []
+        for pattern in ('/usr/lib/*/libeatmydata.so*',
+                        '/usr/lib/libeatmydata.so*'):
+            libs.extend(sorted(glob.glob(self.chroot.chroot_path(pattern))))
+        if not libs:
+            print 'APT BULK libeatmydata not installed in chroot'
+            return
+
+        # The preload of a resumed build is already set up. The backup
+        # never holds libeatmydata, so that it is not restored into the
+        # image by _bulk_deinit().
+        preload = self.chroot.chroot_path(self._bulk_preload)
+        backup = preload + '.fll-bulk'
+        lines = []
+        if os.path.exists(backup):
+            with open(backup) as fh:
+                lines = fh.read().splitlines()
+        elif os.path.exists(preload):
+            with open(preload) as fh:
+                lines = [line for line in fh.read().splitlines()
+                         if 'libeatmydata' not in line]
+            if lines:
+                with open(backup, 'w') as fh:
+                    for line in lines:
+                        print >>fh, line
+        with open(preload, 'w') as fh:
+            for line in lines + [self.chroot.chroot_path_rel(libs[0])]:
+                print >>fh, line
+
+    def _bulk_triggers(self):
+        """Run the triggers deferred during a bulk commit in one pass, and
+        configure any packages which were waiting for them."""
+        self.chroot.cmd(['dpkg', '--triggers-only', '--pending'])
+        self.chroot.cmd(['dpkg', '--configure', '--pending'])
+
+    def _bulk_deinit(self):
+        """Remove the bulk installation settings, so they do not remain in
+        the chroot."""
+        for keyword in ('DPkg::NoTriggers', 'DPkg::ConfigurePending',
+                        'DPkg::TriggersPending'):
+            apt_pkg.config.clear(keyword)
+
+        cfg = self.chroot.chroot_path(self._bulk_dpkg_cfg)
+        if os.path.exists(cfg):
+            os.unlink(cfg)
+
+        preload = self.chroot.chroot_path(self._bulk_preload)
+        if os.path.exists(preload + '.fll-bulk'):
+            os.rename(preload + '.fll-bulk', preload)
+        elif os.path.exists(preload):
+            os.unlink(preload)
+
     def sources_list(self, final_uri=False, src=False):
         """Write apt sources to file(s) in /etc/apt/sources.list.d/*.list.
         Create /etc/apt/sources.list with some boilerplate text about
@@ -104,6 +215,21 @@ class AptLib(object):
                  'managed via the apt-cdrom utility.']
         write_sources_list_comment(sources_list, lines)
 
+        mirror = '/etc/apt/sources.list.d/fll-mirror.list'
+        mirror = self.chroot.chroot_path(mirror)
+        if os.path.exists(mirror):
+            os.unlink(mirror)
+
+        if not final_uri and self.config['mirror']['mode'] == 'use':
+            # only the mirror may be used, drop the lists of the sources
+            for name in self.config['sources'].keys():
+                fname = '/etc/apt/sources.list.d/%s.list' % name
+                fname = self.chroot.chroot_path(fname)
+                if os.path.exists(fname):
+                    os.unlink(fname)
+            self._mirror_sources_list(mirror)
+            return
+
         for name, source in self.config['sources'].iteritems():
             description = source.get('description')
             if final_uri and source.get('final_uri'):
@@ -138,10 +264,16 @@ class AptLib(object):
 
     def key(self, disable=False):
         """Import and gpg keys, install any -keyring packages that are
-        required to authenticate apt sources. Update and refresh apt cache."""
+        required to authenticate apt sources. Update and refresh apt cache.
+        Pending installs are marked again afterwards, a prefetch is waited
+        for first."""
         if disable is True:
             return
 
+        self._prefetch_wait()
+        pending = self._requested()
+        self.cache.clear()
+
         gpgkeys = []
         keyrings = []
 
@@ -186,6 +318,8 @@ class AptLib(object):
         if keyrings or fetch_keys or recv_keys:
             self.update()
 
+        self.install(pending, commit=False)
+
     def commit(self):
         print 'APT COMMIT INSTALL %d DELETE %d GET %sB REQ %sB' % \
             (self.cache.install_count,
@@ -193,19 +327,265 @@ class AptLib(object):
              apt_pkg.size_to_str(self.cache.required_download),
              apt_pkg.size_to_str(self.cache.required_space))
 
-        mounted = self.chroot.mountvirtfs()
+        self._archives_seed()
         try:
-            self.cache.commit(fetch_progress=self._progress)
+            self._prefetch_wait()
+            self.chroot.ensure_space(self.cache.required_space +
+                                     self.cache.required_download,
+                                     release=self._released)
+            # After ensure_space(), which may reopen the cache.
+            versions = [pkg.candidate for pkg in self.cache.get_changes()
+                        if pkg.marked_install or pkg.marked_upgrade or
+                        pkg.marked_reinstall]
+            with self.chroot.virtfs():
+                self.cache.commit(fetch_progress=self._progress)
+                if self.config['bulk']:
+                    self._bulk_triggers()
+            if self.config['mirror']['mode'] == 'build':
+                self._mirror_store(versions)
         except apt.cache.FetchFailedException, e:
             raise AptLibError('apt failed to fetch required archives')
         except SystemError, e:
             raise AptLibError('apt encountered an error: %s' % e)
         finally:
-            if mounted > 0:
-                self.chroot.umountvirtfs()
+            self._archives_harvest()
 
         self.open()
 
+    def prefetch(self):
+        """Start fetching the archives of the pending changes into the
+        chroot in a background thread. commit() waits for it to finish and
+        then installs from the fetched archives. The apt cache must not be
+        modified while the archives are being fetched."""
+        self._archives_seed()
+        self.chroot.ensure_space(self.cache.required_space +
+                                 self.cache.required_download,
+                                 release=self._released)
+
+        def fetch():
+            try:
+                self.cache.fetch_archives(progress=self._progress)
+            except (apt.cache.FetchFailedException, SystemError), e:
+                self._prefetch_error = e
+
+        print 'APT PREFETCH'
+        self._prefetch = threading.Thread(target=fetch)
+        self._prefetch.daemon = True
+        self._prefetch.start()
+
+    def _prefetch_wait(self):
+        """Wait for prefetch() to finish."""
+        if self._prefetch is None:
+            return
+
+        self._prefetch.join()
+        self._prefetch = None
+        if self._prefetch_error is not None:
+            e, self._prefetch_error = self._prefetch_error, None
+            raise AptLibError('apt failed to prefetch archives: %s' % e)
+
+    def _archives_seed(self):
+        """Link archives required by the pending changes from the host's
+        archive cache into the chroot. Each cached archive is verified
+        against the size and checksum of the Packages index first."""
+        cache = self.config['cache']
+        if not cache['enable'] or not os.path.isdir(cache['dir']):
+            return
+
+        archives = self.chroot.chroot_path('/var/cache/apt/archives')
+        seeded = 0
+
+        for pkg in self.cache.get_changes():
+            if not (pkg.marked_install or pkg.marked_upgrade or
+                    pkg.marked_reinstall):
+                continue
+            version = pkg.candidate
+            name = archive_filename(version)
+            src = os.path.join(cache['dir'], name)
+            dst = os.path.join(archives, name)
+            if not os.path.isfile(src) or os.path.exists(dst):
+                continue
+
+            if not version.sha256 or \
+               os.path.getsize(src) != version.size or \
+               fll.cache.checksum(src) != version.sha256:
+                print 'APT CACHE INVALID ' + name
+                os.unlink(src)
+                continue
+
+            fll.cache.link(src, dst)
+            fll.cache.touch(src)
+            seeded += 1
+
+        if seeded:
+            print 'APT CACHE SEEDED %d archives' % seeded
+
+    def _archives_harvest(self):
+        """Move archives downloaded into the chroot to the host's archive
+        cache, so later builds of any architecture may reuse them. Archive
+        file names are unique per architecture, so Architecture: all
+        packages are only stored once."""
+        cache = self.config['cache']
+        if not cache['enable']:
+            return
+
+        archives = self.chroot.chroot_path('/var/cache/apt/archives')
+        if not os.path.isdir(cache['dir']):
+            os.makedirs(cache['dir'])
+
+        for name in os.listdir(archives):
+            if not name.endswith('.deb'):
+                continue
+            src = os.path.join(archives, name)
+            dst = os.path.join(cache['dir'], name)
+            if not os.path.exists(dst):
+                fll.cache.link(src, dst)
+            os.unlink(src)
+
+        for fname in fll.cache.prune(cache['dir'], maxage=cache['maxage'],
+                                     maxsize=cache['maxsize']):
+            print 'APT CACHE EVICTED ' + os.path.basename(fname)
+
+    def _mirror_packages(self):
+        """Return the filename of the Packages index of the local mirror for
+        the chroot's architecture."""
+        return os.path.join(self.config['mirror']['dir'], 'dists', 'fll',
+                            'main', 'binary-%s' % self.chroot.architecture,
+                            'Packages')
+
+    def _mirror_sources_list(self, filename):
+        """Write an apt source for the local mirror. The copy method is used
+        so that apt copies archives into the chroot, where dpkg finds
+        them."""
+        if not os.path.isfile(self._mirror_packages()):
+            raise AptLibError('no local mirror for %s in %s' %
+                              (self.chroot.architecture,
+                               self.config['mirror']['dir']))
+
+        uri = 'copy:' + os.path.abspath(self.config['mirror']['dir'])
+        try:
+            with open(filename, 'w') as fh:
+                print >>fh, 'deb [trusted=yes] %s fll main' % uri
+        except IOError, e:
+            raise AptLibError('failed to write %s: %s' % (filename, e))
+
+    def _mirror_forget(self):
+        """Remove the index files of the local mirror from the chroot's apt
+        lists."""
+        uri = 'copy:' + os.path.abspath(self.config['mirror']['dir'])
+        prefix = apt_pkg.uri_to_filename(uri)
+        lists = self.chroot.chroot_path('/var/lib/apt/lists')
+        for name in os.listdir(lists):
+            if name.startswith(prefix):
+                os.unlink(os.path.join(lists, name))
+
+    def _mirror_store(self, versions):
+        """Add the archives of the given apt.package.Version objects to the
+        local mirror and regenerate its Packages and Release files. The
+        Packages stanzas are those of the original index, with Filename
+        pointing into the mirror's pool."""
+        mirror = self.config['mirror']['dir']
+        pool = os.path.join(mirror, 'pool')
+        packages = self._mirror_packages()
+        archives = self.chroot.chroot_path('/var/cache/apt/archives')
+
+        for dirname in (pool, os.path.dirname(packages)):
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+        with open(os.path.join(mirror, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            stanzas = dict()
+            if os.path.isfile(packages):
+                for stanza in open(packages).read().split('\n\n'):
+                    if not stanza.strip():
+                        continue
+                    section = apt_pkg.TagSection(stanza)
+                    if 'Package' in section:
+                        key = (section['Package'], section['Version'],
+                               section['Architecture'])
+                        stanzas[key] = stanza.strip('\n')
+
+            stored = 0
+            for version in versions:
+                name = archive_filename(version)
+                src = os.path.join(archives, name)
+                dst = os.path.join(pool, name)
+                if not os.path.isfile(src):
+                    continue
+                if not os.path.exists(dst):
+                    fll.cache.link(src, dst)
+
+                record = version.record
+                lines = ['Package: %s' % record['Package']]
+                for field in record.keys():
+                    if field == 'Package':
+                        continue
+                    elif field == 'Filename':
+                        lines.append('Filename: pool/%s' % name)
+                    else:
+                        lines.append('%s: %s' % (field, record[field]))
+                key = (version.package.shortname, version.version,
+                       version.architecture)
+                stanzas[key] = '\n'.join(lines)
+                stored += 1
+
+            with open(packages + '.tmp', 'w') as fh:
+                for key in sorted(stanzas):
+                    print >>fh, stanzas[key] + '\n'
+            os.rename(packages + '.tmp', packages)
+            self._mirror_release()
+
+        print 'APT MIRROR STORED %d archives' % stored
+
+    def _mirror_release(self):
+        """Write the Release file of the local mirror."""
+        dists = os.path.join(self.config['mirror']['dir'], 'dists', 'fll')
+        components = os.path.join(dists, 'main')
+        arches = sorted([d.split('-', 1)[1] for d in os.listdir(components)
+                         if d.startswith('binary-')])
+
+        with open(os.path.join(dists, 'Release'), 'w') as fh:
+            print >>fh, 'Origin: fll'
+            print >>fh, 'Label: fll'
+            print >>fh, 'Suite: fll'
+            print >>fh, 'Codename: fll'
+            print >>fh, 'Date: %s' % time.strftime('%a, %d %b %Y %H:%M:%S UTC',
+                                                   time.gmtime())
+            print >>fh, 'Architectures: %s' % ' '.join(arches)
+            print >>fh, 'Components: main'
+            print >>fh, 'SHA256:'
+            for arch in arches:
+                fname = 'main/binary-%s/Packages' % arch
+                path = os.path.join(dists, fname)
+                print >>fh, ' %s %d %s' % (fll.cache.checksum(path),
+                                           os.path.getsize(path), fname)
+
+    def _requested(self):
+        """Return the names of the packages marked for installation which
+        were requested, not pulled in as dependencies. Marking these again
+        with install() restores the pending changes, and the dependencies
+        stay automatically installed."""
+        return [pkg.name for pkg in self.cache.get_changes()
+                if (pkg.marked_install or pkg.marked_upgrade) and
+                not pkg.is_auto_installed]
+
+    @contextmanager
+    def _released(self):
+        """Close the apt cache, which keeps files below the chroot's rootdir
+        open, for the duration of the context, e.g. while the chroot is moved
+        to disk. It is then opened again and the pending installs are marked
+        again, keeping the dependencies automatically installed."""
+        pending = self._requested()
+        self.cache = None
+        gc.collect()
+        try:
+            yield
+        finally:
+            self._init_cache()
+            self.install(pending, commit=False)
+
     def update(self):
         print 'APT UPDATE'
         try:
@@ -227,6 +607,8 @@ class AptLib(object):
     def install(self, packages, commit=True):
         #with self.cache.actiongroup(): # segfaults
         for p in packages:
+            if p not in self.cache:
+                raise AptLibError('unknown package: %s' % p)
             self.cache[p].mark_install()
 
         if commit:
@@ -248,13 +630,57 @@ class AptLib(object):
             if pkg.is_installed:
                 yield pkg
 
+    def required(self):
+        """Return the names of essential and required priority packages,
+        which are installed by a bootstrap of any flavour."""
+        return [pkg.name for pkg in self.cache if pkg.candidate and
+                (pkg.essential or pkg.candidate.priority == 'required')]
+
+    def totals(self):
+        """Return the install and delete counts, download size and required
+        space of the pending changes, as a baseline for estimate()."""
+        return (self.cache.install_count, self.cache.delete_count,
+                self.cache.required_download, self.cache.required_space)
+
+    def estimate(self, base=None):
+        """Print the pending changes as commit() would, with an estimate of
+        the download time based on the throughput of the last update. With
+        base, a baseline returned by totals(), only the changes on top of
+        the baseline are counted. Return the estimated number of seconds,
+        or None if unknown."""
+        install, delete, download, space = self.totals()
+        if base is not None:
+            install -= base[0]
+            delete -= base[1]
+            download -= base[2]
+            space -= base[3]
+
+        print 'APT ESTIMATE INSTALL %d DELETE %d GET %sB REQ %sB' % \
+            (install, delete, apt_pkg.size_to_str(download),
+             apt_pkg.size_to_str(space))
+
+        rate = self._progress.rate
+        if not rate:
+            print 'APT ESTIMATE download time unknown'
+            return None
+
+        seconds = download / rate
+        print 'APT ESTIMATE download %dm:%02ds at %sB/s' % \
+            (divmod(int(seconds), 60) + (apt_pkg.size_to_str(rate),))
+        return seconds
+
 
 class AptLibProgress(apt.progress.base.AcquireProgress):
-    """Progress report for apt."""
-    def __init__(self, quiet=False):
+    """Progress report for apt. The duration of each download is measured,
+    and the slowest downloads are listed when the download run is done."""
+    def __init__(self, quiet=False, slowest=5):
         apt.progress.base.AcquireProgress.__init__(self)
         self._quiet = quiet
+        self._slowest = slowest
         self._time = None
+        self._started = dict()
+        self._durations = list()
+        self.rate = 0
 
     def fail(self, item):
         apt.progress.base.AcquireProgress.fail(self, item)
@@ -282,15 +708,32 @@ class AptLibProgress(apt.progress.base.AcquireProgress):
             line += ' [%sB]' % apt_pkg.size_to_str(item.owner.filesize)
         if self._quiet is False:
             print line
+        self._started[item.uri] = time.time()
+
+    def done(self, item):
+        apt.progress.base.AcquireProgress.done(self, item)
+        started = self._started.pop(item.uri, None)
+        if started is not None:
+            self._durations.append((time.time() - started,
+                                    item.owner.filesize, item.description))
 
     def start(self):
         apt.progress.base.AcquireProgress.start(self)
         self._time = datetime.datetime.utcnow()
+        self._started = dict()
+        self._durations = list()
 
     def stop(self):
         apt.progress.base.AcquireProgress.stop(self)
         duration = datetime.datetime.utcnow() - self._time
 
+        fll.report.downloaded(self.fetched_bytes)
+
+        seconds = duration.days * 86400 + duration.seconds + \
+                  duration.microseconds / 1e6
+        if self.fetched_bytes and seconds:
+            self.rate = self.fetched_bytes / seconds
+
         if self.total_items == 0:
             return
 
@@ -300,4 +743,13 @@ class AptLibProgress(apt.progress.base.AcquireProgress):
         else:
             line += ' in %d.%ds' % (duration.seconds, duration.microseconds)
         line += ' [%sB]' % apt_pkg.size_to_str(self.total_bytes)
+        if self.rate:
+            line += ' [%sB/s]' % apt_pkg.size_to_str(self.rate)
         print line
+
+        self._durations.sort(reverse=True)
+        for duration, size, description in self._durations[:self._slowest]:
+            line = 'APT SLOW %s [%.1fs' % (description, duration)
+            if size and duration:
+                line += ' %sB/s' % apt_pkg.size_to_str(size / duration)
+            print line + ']'
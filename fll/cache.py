@@ -0,0 +1,92 @@
+"""
+This is the fll.cache module, it provides helper functions for managing
+on-disk caches which are shared between builds.
+
+Copyright: Copyright (C) 2026 The fll contributors
+License:   GPL-2
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+
+def digest(*items):
+    """Return a hex digest which identifies the given items. Items may be
+    strings or lists of strings."""
+    sha = hashlib.sha1()
+    for item in items:
+        if isinstance(item, (list, tuple)):
+            item = ','.join(item)
+        sha.update('%s\0' % item)
+    return sha.hexdigest()
+
+
+def checksum(filename, algorithm='sha256'):
+    """Return the hex digest of the contents of filename."""
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(2**20), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def link(src, dst):
+    """Hard link src to dst, or copy it if they are on different
+    filesystems. The destination appears atomically, so concurrent builds
+    sharing a cache never see a partial file."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst), prefix='.')
+    os.close(fd)
+    os.unlink(tmp)
+    try:
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copy2(src, tmp)
+        os.rename(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def touch(filename):
+    """Mark a cache entry as recently used."""
+    os.utime(filename, None)
+
+
+def prune(dirname, maxage=0, maxsize=0):
+    """Remove entries of cache directory which were not used within maxage
+    days, then remove least recently used entries until the total size of
+    the cache is no more than maxsize MB. A limit of 0 disables it. Return
+    the list of files removed."""
+    if not os.path.isdir(dirname):
+        return []
+
+    entries = []
+    for name in os.listdir(dirname):
+        path = os.path.join(dirname, name)
+        if not os.path.isfile(path) or name.startswith('.'):
+            continue
+        st = os.stat(path)
+        entries.append((st.st_mtime, st.st_size, path))
+    entries.sort()
+
+    removed = []
+    total = sum([e[1] for e in entries])
+    now = time.time()
+
+    for mtime, size, path in entries:
+        expired = maxage > 0 and now - mtime > maxage * 86400
+        oversize = maxsize > 0 and total > maxsize * 2**20
+        if not (expired or oversize):
+            continue
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
+        removed.append(path)
+
+    return removed
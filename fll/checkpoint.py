@@ -0,0 +1,146 @@
+"""
+This is the fll.checkpoint module, it provides a class for recording the
+completed stages of a build, so that a failed build may be resumed from
+the last completed stage.
+
+Copyright: Copyright (C) 2026 The fll contributors
+License:   GPL-2
+"""
+
+import fll.cache
+import fll.misc
+import json
+import os
+import shutil
+
+
+def digest(config, arch):
+    """Return a digest of a fll.config.Config object's config which
+    identifies the build of the chroot of arch. Options which do not
+    affect the contents of the chroot, such as the other architectures,
+    the output directory and the compression settings, are ignored."""
+    config = config.dict()
+    config['chroot'].pop('checkpoint', None)
+    for key in ['archs', 'dir', 'fscomp', 'jobs', 'dryrun', 'verbosity']:
+        config.pop(key, None)
+    config['arch'] = arch
+    return fll.cache.digest(json.dumps(config, sort_keys=True))
+
+
+class CheckpointError(Exception):
+    """
+    An Error class for use by Checkpoint.
+    """
+    pass
+
+
+class Checkpoint(object):
+    """
+    A class which records completed build stages of a chroot next to it,
+    and optionally snapshots the chroot after each stage.
+
+    Options        Type                Description
+    --------------------------------------------------------------------------
+    chroot       - (fll.chroot.Chroot) fll.chroot.Chroot object
+    config       - (dict)              the 'checkpoint' section of the
+                                       'chroot' section of fll.config.Config
+    digest       - (str)               digest of the build configuration
+    """
+    def __init__(self, chroot=None, config={}, digest=None):
+        if chroot is None:
+            raise CheckpointError('must specify chroot=')
+        if not config:
+            raise CheckpointError('must specify config=')
+
+        self.chroot = chroot
+        self.config = config
+        self.digest = digest
+        self.enabled = config['enable'] or config['resume']
+        self.filename = chroot.rootdir + '.checkpoint'
+        self.snapshot = chroot.rootdir + '.snapshot'
+        self.completed = list()
+
+        if config['snapshot'] != 'none' and chroot.lower is not None:
+            print 'CHECKPOINT snapshots are not supported for layered chroots'
+            self.config = dict(config, snapshot='none')
+
+        if not os.path.isfile(self.filename):
+            return
+
+        if config['resume']:
+            try:
+                with open(self.filename) as fh:
+                    state = json.load(fh)
+            except (IOError, ValueError), e:
+                raise CheckpointError('failed to read %s: %s' %
+                                      (self.filename, e))
+            if state.get('digest') == digest:
+                self.completed = state.get('stages', [])
+            else:
+                print 'CHECKPOINT configuration changed, not resuming'
+
+        if self.completed:
+            print 'CHECKPOINT resuming after stage: ' + self.completed[-1]
+            if os.path.isdir(self.snapshot):
+                self._restore()
+        else:
+            # Remains of a build which can not be resumed.
+            self.chroot.nuke()
+            self.clear()
+
+    def done(self, stage):
+        """Return True if stage was completed by a previous build."""
+        return stage in self.completed
+
+    def mark(self, stage):
+        """Record stage as completed, and snapshot the chroot."""
+        if not self.enabled:
+            return
+
+        self.completed.append(stage)
+        if self.config['snapshot'] == 'reflink':
+            self._snapshot()
+
+        try:
+            with open(self.filename, 'w') as fh:
+                json.dump({'digest': self.digest, 'stages': self.completed},
+                          fh)
+        except IOError, e:
+            raise CheckpointError('failed to write %s: %s' %
+                                  (self.filename, e))
+
+    def clear(self):
+        """Remove checkpoint records and snapshot."""
+        if os.path.isfile(self.filename):
+            os.unlink(self.filename)
+        if os.path.isdir(self.snapshot):
+            shutil.rmtree(self.snapshot)
+
+    def _copy(self, src, dst):
+        """Copy a chroot tree, sharing data blocks with the source. Virtual
+        filesystems mounted in the chroot are not copied."""
+        tmp = dst + '.tmp'
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        try:
+            fll.misc.cmd(['cp', '-a', '--reflink=always', '--one-file-system',
+                          src, tmp], silent=True)
+        except OSError, e:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+            raise CheckpointError('failed to snapshot %s: %s' % (src, e))
+        for mnt in ['dev/pts', 'proc', 'sys']:
+            if not os.path.isdir(os.path.join(tmp, mnt)):
+                os.makedirs(os.path.join(tmp, mnt))
+        if os.path.isdir(dst):
+            shutil.rmtree(dst)
+        os.rename(tmp, dst)
+
+    def _snapshot(self):
+        print 'CHECKPOINT snapshot after stage: ' + self.completed[-1]
+        self._copy(self.chroot.rootdir, self.snapshot)
+
+    def _restore(self):
+        print 'CHECKPOINT restoring snapshot: ' + self.snapshot
+        self.chroot.nuke()
+        self._copy(self.snapshot, self.chroot.rootdir)
@@ -7,14 +7,23 @@ Copyright: Copyright (C) 2010 Kel Modderman <kel@otaku42.de>
 License:   GPL-2
 """
 
+from contextlib import contextmanager, nested
+
+import fll.cache
 import fll.misc
+import fll.report
 import os
+import pipes
+import re
 import subprocess
 import shlex
 import shutil
+import multiprocessing
 import signal
 import sys
 import tempfile
+import threading
+import urllib2
 
 
 class ChrootError(Exception):
@@ -34,12 +43,17 @@ class Chroot(object):
     rootdir      - (str)  path to root of chroot
     architecture - (str)  architecture of chroot
     config       - (dict) the 'chroot' section of fll.config.Config object
+    lower        - (str)  path to root of a bootstrapped and initialised
+                          chroot. When given, the chroot is an overlayfs
+                          mount of a writable layer on top of it, instead
+                          of being bootstrapped.
     """
     diverts = ['/usr/sbin/policy-rc.d', '/sbin/modprobe', '/sbin/insmod',
                '/usr/sbin/update-grub', '/usr/sbin/update-initramfs',
                '/sbin/initctl', '/sbin/start-stop-daemon']
 
-    def __init__(self, rootdir=None, architecture=None, config={}):
+    def __init__(self, rootdir=None, architecture=None, config={},
+                 lower=None):
         if rootdir is None:
             raise AptLibError('must specify rootdir=')
         if architecture is None:
@@ -51,18 +65,43 @@ class Chroot(object):
         self.architecture = architecture
         self.config = config
         self.mounted = list()
+        self.diverts = self.diverts + [d for d in config['diverts']
+                                       if d not in self.diverts]
+        self._server = None
+        self._server_lock = threading.Lock()
+        # A chroot kept for --resume may still be in memory.
+        self.tmpfs = self._tmpfs_mounted()
+        self.lower = lower
+        if lower is not None:
+            self.lower = os.path.realpath(lower)
+            self.upperdir = self.rootdir + '.upper'
+            self.workdir = self.rootdir + '.work'
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
+        self.stop_server()
         self.umountvirtfs()
-        if not self.config['preserve']:
-            self.nuke()
+        if self.config['preserve']:
+            return
+        checkpoint = self.config['checkpoint']
+        if type is not None and (checkpoint['enable'] or checkpoint['resume']):
+            print 'HOST keeping chroot for --resume: %s' % self.rootdir
+            return
+        self.nuke()
 
     def bootstrap(self):
         """Bootstrap a Debian chroot. By default it will bootstrap a minimal
-        sid chroot with cdebootstrap."""
+        sid chroot with cdebootstrap. A layered chroot is mounted on top of
+        its lower chroot instead."""
+        if self.lower is not None:
+            self.mountoverlay()
+            return
+
+        if self.config['tmpfs']['enable']:
+            self.mounttmpfs()
+
         utility = self.config['bootstrap']['utility']
         uri = self.config['bootstrap']['uri']
         suite = self.config['bootstrap']['suite']
@@ -106,6 +145,12 @@ class Chroot(object):
         cmd.append(self.rootdir)
         cmd.append(uri)
 
+        archive = None
+        if self.config['cache']['enable']:
+            archive = self._bootstrap_archive()
+            if archive and self._bootstrap_restore(archive):
+                return
+
         try:
             fll.misc.cmd(cmd)
         except OSError:
@@ -117,6 +162,91 @@ class Chroot(object):
             self.cmd('dpkg --purge cdebootstrap-helper-rc.d'.split(),
                      silent=self.config['quiet'])
 
+        if archive:
+            self._bootstrap_store(archive)
+
+    def _bootstrap_archive(self):
+        """Return the filename of the cached bootstrap archive for the
+        current bootstrap parameters. The date of the mirror's Release file
+        is part of the key, so a cached chroot is only reused until the
+        mirror is updated. Return None if the Release date is unknown."""
+        bootstrap = self.config['bootstrap']
+        uri = bootstrap['uri'].rstrip('/')
+        release = '%s/dists/%s/Release' % (uri, bootstrap['suite'])
+
+        date = None
+        try:
+            fh = urllib2.urlopen(release, timeout=60)
+            try:
+                for line in fh:
+                    if line.startswith('Date:'):
+                        date = line.partition(':')[2].strip()
+                        break
+            finally:
+                fh.close()
+        except (urllib2.URLError, IOError), e:
+            print 'HOST bootstrap cache disabled, %s: %s' % (release, e)
+            return None
+
+        if date is None:
+            return None
+
+        key = fll.cache.digest(bootstrap['utility'], bootstrap['suite'],
+                               bootstrap['flavour'], bootstrap['include'],
+                               bootstrap['exclude'], self.architecture,
+                               uri, date)
+        return os.path.join(self.config['cache']['dir'],
+                            '%s_%s.tar.gz' % (self.architecture, key))
+
+    def _bootstrap_restore(self, archive):
+        """Unpack a cached bootstrap archive into the chroot. Return True
+        on success."""
+        if not os.path.isfile(archive):
+            return False
+
+        if not os.path.isdir(self.rootdir):
+            os.makedirs(self.rootdir)
+
+        try:
+            fll.misc.cmd(['tar', '-C', self.rootdir, '--numeric-owner',
+                          '-xzpf', archive])
+        except OSError, e:
+            print 'HOST bootstrap cache unusable: %s' % e
+            os.unlink(archive)
+            return False
+
+        fll.cache.touch(archive)
+        return True
+
+    def _bootstrap_store(self, archive):
+        """Store the freshly bootstrapped chroot in the bootstrap cache and
+        evict stale entries."""
+        cache = self.config['cache']
+        cachedir = os.path.dirname(archive)
+
+        try:
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+            fd, tmp = tempfile.mkstemp(dir=cachedir, prefix='.')
+            os.close(fd)
+        except OSError, e:
+            print 'HOST bootstrap cache not written: %s' % e
+            return
+
+        try:
+            fll.misc.cmd(['tar', '-C', self.rootdir, '--numeric-owner',
+                          '-czpf', tmp, '.'])
+            os.rename(tmp, archive)
+        except OSError, e:
+            print 'HOST bootstrap cache not written: %s' % e
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            return
+
+        for fname in fll.cache.prune(cachedir, maxage=cache['maxage'],
+                                     maxsize=cache['maxsize']):
+            print 'HOST bootstrap cache evicted: %s' % fname
+
     def debconf_set_selections(self, selections):
         dss = '/usr/bin/debconf-set-selections'
 
@@ -135,9 +265,33 @@ class Chroot(object):
             cmd.append(self.chroot_path_rel(fh.name))
             self.cmd(cmd)
 
+    def skeleton(self):
+        """Create the minimal directory structure required by apt, so that
+        apt's indices may be downloaded into an empty rootdir without a
+        bootstrap. The host's trusted apt keys are copied to verify them."""
+        for dirname in ('/etc/apt/apt.conf.d', '/etc/apt/preferences.d',
+                        '/etc/apt/sources.list.d', '/etc/apt/trusted.gpg.d',
+                        '/var/lib/apt/lists/partial', '/var/lib/dpkg',
+                        '/var/cache/apt/archives/partial'):
+            if not os.path.isdir(self.chroot_path(dirname)):
+                os.makedirs(self.chroot_path(dirname))
+
+        self.create_file('/var/lib/dpkg/status')
+
+        keys = ['/etc/apt/trusted.gpg']
+        if os.path.isdir('/etc/apt/trusted.gpg.d'):
+            keys.extend([os.path.join('/etc/apt/trusted.gpg.d', k)
+                         for k in os.listdir('/etc/apt/trusted.gpg.d')])
+        for key in keys:
+            if os.path.isfile(key):
+                shutil.copy(key, self.chroot_path(key))
+
     def init(self):
         """Configure the basics to get a functioning chroot."""
-        self.mountvirtfs()
+        if self.lower is not None:
+            # Inherited from the lower chroot.
+            return
+
         for fname in ('/etc/hosts', '/etc/resolv.conf'):
             if os.path.isfile(self.chroot_path(fname)):
                 os.unlink(self.chroot_path(fname))
@@ -147,15 +301,35 @@ class Chroot(object):
                       '/etc/network/interfaces'):
             self.create_file(fname)
 
+        self.divert(add=True)
         for fname in self.diverts:
-            cmd = 'dpkg-divert --add --local --divert ' + fname + '.REAL'
-            cmd += ' --rename ' + fname
-            self.cmd(cmd, silent=self.config['quiet'])
             self.create_file(fname, mode=0755)
 
         debconf = ['man-db man-db/auto-update boolean false']
         self.debconf_set_selections(debconf)
 
+    def divert(self, add=True):
+        """Add, or remove, local diversions of all files in self.diverts.
+        All dpkg-divert commands are executed by a single chrooted shell
+        script rather than one chrooted command per file."""
+        with tempfile.NamedTemporaryFile(dir=self.rootdir, prefix='divert_') \
+             as fh:
+            print >>fh, 'set -e'
+            for fname in self.diverts:
+                fname = pipes.quote(fname)
+                if add:
+                    print >>fh, 'dpkg-divert --add --local --divert ' \
+                                '%s.REAL --rename %s' % (fname, fname)
+                else:
+                    # only diversions which still exist, so that a resumed
+                    # deinit may run this again
+                    print >>fh, 'if [ -n "$(dpkg-divert --listpackage ' \
+                                '%s)" ]; then dpkg-divert --remove ' \
+                                '--rename %s; fi' % (fname, fname)
+            fh.flush()
+            self.cmd(['/bin/sh', self.chroot_path_rel(fh.name)],
+                     silent=self.config['quiet'])
+
     def deinit(self):
         """Undo any changes in the chroot which should be undone. Make any
         final configurations."""
@@ -166,34 +340,197 @@ class Chroot(object):
                 continue
             self.create_file(fname)
 
+        # Only remove stubs which are still in place: a resumed deinit runs
+        # again after the real files have been restored.
         for fname in self.diverts:
-            os.unlink(self.chroot_path(fname))
-            cmd = 'dpkg-divert --remove --rename ' + fname
-            self.cmd(cmd, silent=self.config['quiet'])
+            if self._is_stub(fname):
+                os.unlink(self.chroot_path(fname))
+        self.divert(add=False)
 
         debconf = ['man-db man-db/auto-update boolean true']
         self.debconf_set_selections(debconf)
-        if os.path.exists(self.chroot_path('/usr/bin/mandb')):
-            self.cmd('/usr/bin/mandb --create --quiet')
 
-        self.makeInitramfs()
-        self.umountvirtfs()
+        with self.virtfs():
+            wait = self.mandb()
+            try:
+                self.makeInitramfs()
+            finally:
+                wait()
+
+    def installed_packages(self):
+        """Return a sorted list of name=version of the packages installed
+        in the chroot, as recorded in the dpkg status file."""
+        packages = list()
+        status = self.chroot_path('/var/lib/dpkg/status')
+        if not os.path.isfile(status):
+            return packages
+
+        fields = dict()
+        for line in open(status).read().split('\n') + ['']:
+            if line and not line[0].isspace() and ':' in line:
+                key, value = line.split(':', 1)
+                fields[key] = value.strip()
+            elif not line:
+                if fields.get('Status', '').endswith(' installed'):
+                    packages.append('%s=%s' % (fields.get('Package'),
+                                               fields.get('Version')))
+                fields = dict()
+        packages.sort()
+        return packages
+
+    def mandb(self):
+        """Generate the man-db index according to the [[mandb]] mode:
+        sync runs mandb to completion, background starts it alongside the
+        rest of deinit, cached reuses an index generated for the same set
+        of installed packages and skip does not generate it at all. Return
+        a function which waits for the index to be complete."""
+        mandb = ['/usr/bin/mandb', '--create', '--quiet']
+        mode = self.config['mandb']['mode']
+        archive = None
+
+        if mode == 'skip' or \
+           not os.path.exists(self.chroot_path(mandb[0])):
+            return lambda: None
+
+        if mode == 'sync':
+            self.cmd(mandb)
+            return lambda: None
+
+        if mode == 'cached':
+            archive = os.path.join(self.config['mandb']['dir'], '%s_%s.tar.gz'
+                                   % (self.architecture, fll.cache.digest(
+                                      self.installed_packages())))
+            if self._mandb_restore(archive):
+                return lambda: None
+
+        print 'CHROOT %s %s &' % (self.rootdir, ' '.join(mandb))
+        proc = self.popen(mandb)
+
+        def wait():
+            if proc.wait() != 0:
+                raise ChrootError('chrooted command returncode=%d: %s' %
+                                  (proc.returncode, ' '.join(mandb)))
+            if archive:
+                self._mandb_store(archive)
+
+        return wait
+
+    def _mandb_restore(self, archive):
+        """Unpack a cached man-db index into the chroot. Return True on
+        success."""
+        if not os.path.isfile(archive):
+            return False
+
+        try:
+            fll.misc.cmd(['tar', '-C', self.rootdir, '--numeric-owner',
+                          '-xzpf', archive])
+        except OSError, e:
+            print 'HOST man-db cache unusable: %s' % e
+            os.unlink(archive)
+            return False
+
+        print 'HOST man-db index restored from cache: %s' % archive
+        fll.cache.touch(archive)
+        return True
+
+    def _mandb_store(self, archive):
+        """Store the man-db index of the chroot in the man-db cache and
+        evict stale entries."""
+        cache = self.config['mandb']
+        cachedir = os.path.dirname(archive)
+
+        try:
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+            fd, tmp = tempfile.mkstemp(dir=cachedir, prefix='.')
+            os.close(fd)
+        except OSError, e:
+            print 'HOST man-db cache not written: %s' % e
+            return
+
+        try:
+            fll.misc.cmd(['tar', '-C', self.rootdir, '--numeric-owner',
+                          '-czpf', tmp, 'var/cache/man'])
+            os.rename(tmp, archive)
+        except OSError, e:
+            print 'HOST man-db cache not written: %s' % e
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            return
+
+        for fname in fll.cache.prune(cachedir, maxage=cache['maxage'],
+                                     maxsize=cache['maxsize']):
+            print 'HOST man-db cache evicted: %s' % fname
 
-    def hookitems(self,hook,items):
-        """run hook with each item"""
+    def hookitems(self, hook, items, jobs=None, failfast=None):
+        """run hook with each item, up to jobs at a time. The output of each
+        run is captured and printed once it completes. With failfast, no
+        more items are started after a failure."""
         # e.g. self.makeImages('/etc/kernel/postinst.d/zs-sunxi-image',self.detectLinuxVersions())
+        items = list(items)
+        if jobs is None:
+            jobs = self.config['hooks']['jobs'] or multiprocessing.cpu_count()
+        if failfast is None:
+            failfast = self.config['hooks']['failfast']
+
         print "running command >>> %s <<< for each item >>> %s <<<" % (hook, ", ".join(items))
-        for i in items:
-            self.cmd(hook % i)
+        if jobs == 1 or len(items) < 2:
+            for i in items:
+                self.cmd(hook % i)
+            return
+
+        pending = list(items)
+        failed = list()
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not pending or (failfast and failed):
+                        return
+                    item = pending.pop(0)
+                cmd = shlex.split(hook % item)
+                try:
+                    # close_fds, so that a job does not hold the output
+                    # pipe of another one open. Parallel jobs are run
+                    # directly, not via the chroot command server.
+                    with fll.report.command(cmd):
+                        proc = self.popen(cmd, stdout=subprocess.PIPE,
+                                          stderr=subprocess.STDOUT,
+                                          close_fds=True)
+                        output = proc.communicate()[0]
+                    returncode = proc.returncode
+                except ChrootError, e:
+                    output = '%s\n' % e
+                    returncode = None
+                with lock:
+                    print 'CHROOT %s %s' % (self.rootdir, ' '.join(cmd))
+                    sys.stdout.write(output)
+                    sys.stdout.flush()
+                    if returncode != 0:
+                        failed.append(item)
+
+        with self.virtfs():
+            threads = [threading.Thread(target=worker)
+                       for n in range(min(jobs, len(items)))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        if failed:
+            raise ChrootError('hook failed for item(s) %s: %s' %
+                              (', '.join(failed), hook))
 
     def detectLinuxVersions(self):
-         """Return version string of installed vmlinu[xz]-*"""
-         kvers = [f[f.find('-')+1:]
+         """Return sorted version strings of installed vmlinu[xz]-*"""
+         kvers = set([f[f.find('-')+1:]
                  for f in os.listdir(os.path.join(self.rootdir, 'boot'))
-                 if f.startswith('vmlinuz-') or f.startswith('vmlinux-')]
-         kvers.sort
-         return(kvers)
- 
+                 if f.startswith('vmlinuz-') or f.startswith('vmlinux-')])
+         # compare numeric parts as numbers, eg. 4.9 < 4.19
+         return(sorted(kvers, key=lambda v: [t.isdigit() and int(t) or t
+                                            for t in re.split(r'(\d+)', v)]))
+
     def makeInitramfs(self):
         """Generate the initramfs if update-initramfs was diverted"""
         hook = '/usr/sbin/update-initramfs'
@@ -206,23 +543,38 @@ class Chroot(object):
     def chroot_path_rel(self, path):
         return path.replace(self.rootdir, '')
 
+    def _stub(self, filename):
+        """Return the contents of the stub which denies execution of a
+        diverted file."""
+        if filename.endswith('policy-rc.d'):
+            retv = 101
+        else:
+            retv = 0
+
+        return """\
+#!/bin/sh
+echo 1>&2
+echo "Command denied: $0 $@" 1>&2
+echo 1>&2
+exit %d
+""" % retv
+
+    def _is_stub(self, filename):
+        """Return True if filename in the chroot is the stub written by
+        create_file()."""
+        path = self.chroot_path(filename)
+        if os.path.islink(path) or not os.path.isfile(path):
+            return False
+        with open(path) as fh:
+            return fh.read() == self._stub(filename)
+
     def create_file(self, filename, mode=0644):
         fh = None
         try:
             fh = open(self.chroot_path(filename), 'w')
 
             if filename in self.diverts:
-                if filename.endswith('policy-rc.d'):
-                    retv = 101
-                else:
-                    retv = 0
-
-                print >>fh, """\
-#!/bin/sh
-echo 1>&2
-echo "Command denied: $0 $@" 1>&2
-echo 1>&2
-exit %d""" % retv
+                fh.write(self._stub(filename))
 
             elif filename == '/etc/fstab':
                 print >>fh, """\
@@ -264,14 +616,137 @@ iface lo inet loopback"""
         virtfs = {'devpts': '/dev/pts', 'proc': '/proc', 'sysfs': '/sys'}
 
         for vfstype, mnt in virtfs.items():
-            cmd = ['mount', '-t', vfstype, 'none', self.chroot_path(mnt)]
             try:
-                subprocess.check_call(cmd, preexec_fn=fll.misc.restore_sigpipe)
+                fll.misc.mount('none', self.chroot_path(mnt), vfstype)
                 self.mounted.append(self.chroot_path(mnt))
-            except (subprocess.CalledProcessError, OSError):
-                raise ChrootError('failed to mount virtfs: ' + mnt)
+            except OSError, e:
+                raise ChrootError('failed to mount virtfs: %s' % e)
         return(len(self.mounted))
 
+    def mountoverlay(self):
+        """Mount a writable overlayfs layer over the lower chroot at the
+        root of the chroot, unless it is already mounted."""
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                if line.split()[1] == self.rootdir:
+                    return
+
+        for dirname in (self.rootdir, self.upperdir, self.workdir):
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+        data = 'lowerdir=%s,upperdir=%s,workdir=%s' % \
+               (self.lower, self.upperdir, self.workdir)
+        print 'HOST overlay %s on %s' % (self.lower, self.rootdir)
+        try:
+            fll.misc.mount('overlay', self.rootdir, 'overlay', data=data)
+        except OSError, e:
+            raise ChrootError('failed to mount overlay: %s' % e)
+
+    def _tmpfs_mounted(self):
+        """Return whether a tmpfs is mounted at the root of the chroot."""
+        return fll.misc.fstype(self.rootdir) == 'tmpfs' and \
+               os.path.ismount(self.rootdir)
+
+    def mounttmpfs(self):
+        """Mount a tmpfs of the configured size at the root of the chroot,
+        so that the chroot is built in memory. The chroot is built on disk
+        if there is not enough memory available for it and the reserve."""
+        if os.path.ismount(self.rootdir):
+            self.tmpfs = self._tmpfs_mounted()
+            return
+
+        if os.path.isdir(self.rootdir) and os.listdir(self.rootdir):
+            print 'HOST chroot exists, not using tmpfs: %s' % self.rootdir
+            return
+
+        size = self.config['tmpfs']['size'] * 1024 * 1024
+        reserve = self.config['tmpfs']['reserve'] * 1024 * 1024
+        available = fll.misc.meminfo('MemAvailable')
+        if size + reserve > available:
+            print 'HOST not enough memory for tmpfs, %s available' % \
+                  fll.report.size_to_str(available)
+            return
+
+        if not os.path.isdir(self.rootdir):
+            os.makedirs(self.rootdir)
+
+        print 'HOST tmpfs %s on %s' % (fll.report.size_to_str(size),
+                                       self.rootdir)
+        try:
+            fll.misc.mount('tmpfs', self.rootdir, 'tmpfs',
+                           data='size=%d,mode=0755' % size)
+        except OSError, e:
+            raise ChrootError('failed to mount tmpfs: %s' % e)
+        self.tmpfs = True
+
+    def ensure_space(self, required, release=None):
+        """Make room for required more bytes in a chroot which is built in
+        memory. The tmpfs is grown if enough memory is available, otherwise
+        the chroot is moved to disk. release is a function returning a
+        context manager, within which the caller has closed any files it
+        holds open below the rootdir; the move is done within it."""
+        if not self.tmpfs:
+            return
+
+        reserve = self.config['tmpfs']['reserve'] * 1024 * 1024
+        st = os.statvfs(self.rootdir)
+        if st.f_bavail * st.f_frsize >= required + reserve:
+            return
+
+        if required + reserve > fll.misc.meminfo('MemAvailable'):
+            self._tmpfs_to_disk(release)
+            return
+
+        size = (st.f_blocks - st.f_bfree) * st.f_frsize + required + reserve
+        print 'HOST tmpfs grow to %s on %s' % (fll.report.size_to_str(size),
+                                               self.rootdir)
+        try:
+            fll.misc.mount('tmpfs', self.rootdir, 'tmpfs',
+                           flags=fll.misc.MS_REMOUNT, data='size=%d' % size)
+        except OSError, e:
+            print 'HOST failed to grow tmpfs: %s' % e
+            self._tmpfs_to_disk(release)
+
+    def _tmpfs_to_disk(self, release=None):
+        """Copy a chroot which is built in memory to disk, and continue the
+        build there."""
+        if release is not None:
+            with release():
+                self._tmpfs_to_disk()
+            return
+
+        print 'HOST moving chroot from tmpfs to disk: %s' % self.rootdir
+        self.stop_server()
+        remount = len(self.mounted) > 0
+        self.umountvirtfs()
+
+        disk = self.rootdir + '.disk'
+        try:
+            os.mkdir(disk)
+            fll.misc.cmd(['cp', '-a', self.rootdir + '/.', disk])
+            self._umount([self.rootdir])
+            os.rmdir(self.rootdir)
+            os.rename(disk, self.rootdir)
+        except OSError, e:
+            raise ChrootError('failed to move chroot to disk: %s' % e)
+        self.tmpfs = False
+
+        if remount:
+            self.mountvirtfs()
+
+    @contextmanager
+    def virtfs(self):
+        """Keep the virtual filesystems mounted for the duration of the
+        context. Commands executed within it reuse the existing mounts
+        instead of mounting and unmounting them for every command."""
+        mounted = self.mountvirtfs()
+        try:
+            yield self
+        finally:
+            if mounted > 0:
+                self.umountvirtfs()
+
     def umountvirtfs(self):
         """Unmount virtual filesystems that are mounted within the chroot."""
         umount = self.mounted
@@ -286,7 +761,8 @@ iface lo inet loopback"""
         with open('/proc/mounts') as mounts:
             for line in mounts:
                 name, mnt, vfstype, opts, freqno, passno = line.split()
-                if mnt.startswith(self.rootdir):
+                if mnt == self.rootdir or \
+                   mnt.startswith(self.rootdir + '/'):
                     umount.append(mnt)
 
         umount.sort(key=len)
@@ -298,22 +774,62 @@ iface lo inet loopback"""
 
         for mnt in umount:
             try:
-                subprocess.check_call(['umount', mnt],
-                                      preexec_fn=fll.misc.restore_sigpipe)
-            except (subprocess.CalledProcessError, OSError):
-                raise ChrootError('failed to umount virtfs: ' + mnt)
+                fll.misc.umount(mnt)
+            except OSError, e:
+                raise ChrootError('failed to umount virtfs: %s' % e)
 
     def nuke(self):
         """Remove the chroot from filesystem. All mount points in chroot
         will be umounted prior to attempted removal."""
+        self.stop_server()
         self.umountall()
 
+        dirnames = [self.rootdir]
+        if self.lower is not None:
+            dirnames.extend([self.upperdir, self.workdir])
+
+        nuke = self.config['nuke']
+        jobs = nuke['jobs'] or multiprocessing.cpu_count()
+
+        for dirname in dirnames:
+            if not os.path.isdir(dirname):
+                continue
+            print 'HOST nuke(%s)' % dirname
+            if not nuke['rmtree'] and self._drop(dirname):
+                continue
+
+            # Move the tree aside, so that the rootdir may be reused at once
+            # while the tombstone is removed.
+            try:
+                tombstone = tempfile.mkdtemp(dir=os.path.dirname(dirname),
+                    prefix='.%s.nuke-' % os.path.basename(dirname))
+                os.rename(dirname, os.path.join(tombstone, 'root'))
+            except OSError, e:
+                raise ChrootError('failed to nuke chroot: %s' % e)
+
+            if nuke['mode'] == 'background':
+                fll.misc.detach(fll.misc.rmtree, tombstone, jobs)
+                continue
+
+            try:
+                fll.misc.rmtree(tombstone, jobs=jobs)
+            except OSError, e:
+                raise ChrootError('failed to nuke chroot: %s' % e)
+
+    def _drop(self, dirname):
+        """Remove dirname in one call if it is a btrfs subvolume. Return True
+        on success. A tmpfs mounted at the rootdir has already been dropped
+        by umountall()."""
+        if fll.misc.fstype(dirname) != 'btrfs' or \
+           os.stat(dirname).st_ino != 256:
+            return False
+
         try:
-            if os.path.isdir(self.rootdir):
-                print 'HOST nuke(%s)' % self.rootdir
-                shutil.rmtree(self.rootdir)
-        except IOError:
-            raise ChrootError('failed to nuke chroot: ' + self.rootdir)
+            fll.misc.cmd(['btrfs', 'subvolume', 'delete', dirname])
+        except OSError, e:
+            print 'HOST failed to delete subvolume %s: %s' % (dirname, e)
+            return False
+        return True
 
     def _chroot(self):
         """Convenience function so that subprocess may be executed in chroot
@@ -322,44 +838,155 @@ iface lo inet loopback"""
         os.chroot(self.rootdir)
         os.chdir('/')
 
-    def cmd(self, cmd, pipe=False, quiet=False, silent=False):
-        """Execute a command in the chroot."""
+    def popen(self, cmd, **kwargs):
+        """Start a command in the chroot and return its subprocess.Popen
+        object, for commands which are connected by pipes. Keyword
+        arguments are passed to subprocess.Popen."""
         if isinstance(cmd, str):
             cmd = shlex.split(cmd)
 
-        if silent is False:
-            print 'CHROOT %s %s' % (self.rootdir, ' '.join(cmd))
+        try:
+            return subprocess.Popen(cmd, preexec_fn=self._chroot, cwd='/',
+                                    **kwargs)
+        except OSError, e:
+            raise ChrootError('chrooted command failed: %s' % e)
 
-        devnull = output = None
+    # Main loop of the chrooted helper. Each request is a line of shell
+    # code which runs a command in a subshell; its exit status is written
+    # back as a line to the status pipe.
+    _server_loop = 'while IFS= read -r request <&%d; do ' \
+                   'eval "$request"; echo $? >&%d; done'
+
+    def start_server(self):
+        """Start a small chrooted shell as a helper process, which executes
+        the commands passed to it by cmd(). The chroot is entered and
+        SIGPIPE restored once, when the helper starts, and each command is
+        forked from the shell instead of from this (large) process."""
+        if self._server is not None:
+            return
 
-        if quiet is False:
-            quiet = self.config['quiet']
+        request_r, request_w = os.pipe()
+        status_r, status_w = os.pipe()
 
-        mounted = self.mountvirtfs()
+        def preexec():
+            os.close(request_w)
+            os.close(status_r)
+            self._chroot()
+
+        try:
+            proc = subprocess.Popen(['/bin/sh', '-c', self._server_loop %
+                                     (request_r, status_w)],
+                                    preexec_fn=preexec, cwd='/')
+        except OSError, e:
+            os.close(request_w)
+            os.close(status_r)
+            raise ChrootError('failed to start chroot command server: %s' % e)
+        finally:
+            os.close(request_r)
+            os.close(status_w)
+
+        self._server = (proc, os.fdopen(request_w, 'w'),
+                        os.fdopen(status_r, 'r'))
+
+    def stop_server(self):
+        """Stop the helper process started by start_server()."""
+        if self._server is None:
+            return
+
+        proc, requests, status = self._server
+        self._server = None
         try:
+            requests.close()
+        except IOError:
+            pass
+        status.close()
+        proc.wait()
+
+    def _serve_cmd(self, cmd, pipe, quiet):
+        """Execute a command via the chrooted helper process. The command
+        is exec'd in a subshell, so shell builtins are not used in place of
+        it. Captured output is written to a temporary file in the chroot.
+        Commands with a newline in an argument cannot be passed as a line
+        and are executed directly."""
+        if [arg for arg in cmd if '\n' in arg]:
+            return self._execute(cmd, pipe, quiet, self._chroot)
+
+        request = '(exec %s)' % ' '.join([pipes.quote(arg) for arg in cmd])
+        output = None
+        with tempfile.NamedTemporaryFile(dir=self.rootdir, prefix='cmd_') \
+             as fh:
             if pipe:
-                proc = subprocess.Popen(cmd, preexec_fn=self._chroot, cwd='/',
-                                        stdout=subprocess.PIPE)
+                request += ' >%s' % pipes.quote(self.chroot_path_rel(fh.name))
+            elif quiet:
+                request += ' >/dev/null'
+
+            with self._server_lock:
+                if self._server is None:
+                    self.start_server()
+                proc, requests, status = self._server
+                try:
+                    requests.write(request + '\n')
+                    requests.flush()
+                    line = status.readline()
+                except IOError:
+                    line = ''
+                if not line:
+                    self.stop_server()
+                    raise ChrootError('chroot command server died')
+
+            if pipe:
+                output = fh.read()
+
+        return int(line), output
+
+    def _execute(self, cmd, pipe, quiet, preexec_fn):
+        """Execute a command, return its returncode and output."""
+        devnull = output = None
+        try:
+            if pipe:
+                proc = subprocess.Popen(cmd, preexec_fn=preexec_fn,
+                                        cwd='/', stdout=subprocess.PIPE)
                 output = proc.communicate()[0]
-            elif quiet or silent:
+            elif quiet:
                 devnull = os.open(os.devnull, os.O_RDWR)
-                proc = subprocess.Popen(cmd, preexec_fn=self._chroot, cwd='/',
-                                        stdout=devnull)
+                proc = subprocess.Popen(cmd, preexec_fn=preexec_fn,
+                                        cwd='/', stdout=devnull)
                 proc.wait()
             else:
-                proc = subprocess.Popen(cmd, preexec_fn=self._chroot, cwd='/')
+                proc = subprocess.Popen(cmd, preexec_fn=preexec_fn,
+                                        cwd='/')
                 proc.wait()
-        except OSError, e:
-            raise ChrootError('chrooted command failed: %s' % e)
         finally:
-            if mounted > 0:
-                self.umountvirtfs()
             if devnull:
                 os.close(devnull)
+        return proc.returncode, output
+
+    def cmd(self, cmd, pipe=False, quiet=False, silent=False):
+        """Execute a command in the chroot."""
+        if isinstance(cmd, str):
+            cmd = shlex.split(cmd)
+
+        if silent is False:
+            print 'CHROOT %s %s' % (self.rootdir, ' '.join(cmd))
+
+        if quiet is False:
+            quiet = self.config['quiet']
+
+        try:
+            with nested(self.virtfs(), fll.report.command(cmd)):
+                if self.config['server']:
+                    returncode, output = self._serve_cmd(cmd, pipe,
+                                                         quiet or silent)
+                else:
+                    returncode, output = self._execute(cmd, pipe,
+                                                       quiet or silent,
+                                                       self._chroot)
+        except OSError, e:
+            raise ChrootError('chrooted command failed: %s' % e)
 
-        if proc.returncode != 0:
+        if returncode != 0:
             raise ChrootError('chrooted command returncode=%d: %s' %
-                              (proc.returncode, ' '.join(cmd)))
+                              (returncode, ' '.join(cmd)))
 
         if pipe:
             return output
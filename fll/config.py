@@ -51,7 +51,8 @@ Examples:
                    dest='dryrun',
                    action='store_true',
                    help="""\
-Dry run mode. Do not perform time consuming processes.""")
+Dry run mode. Resolve the package profile against apt's indices only and
+report what would be downloaded and installed, without building.""")
 
     m = p.add_mutually_exclusive_group()
     m.add_argument('--verbosity',
@@ -126,6 +127,13 @@ Architecture of chroot filesystem(s) to build. Multiple architectures
 can be specified separarted by whitespace.
 Default: host architecture""")
 
+    d.add_argument('--jobs', '-j',
+                   type=int,
+                   metavar='<JOBS>',
+                   help="""\
+Number of architectures to build in parallel, each in a separate process.
+Default: 1""")
+
     d.add_argument('--suites', '-s',
                    dest='apt_sources_debian_suites',
                    metavar='<SUITE>',
@@ -165,6 +173,20 @@ Set distro defaults configuration. Each argument is a keyword=value pair.""")
 
     a = p.add_argument_group(title='apt related arguments')
 
+    a.add_argument('--apt-prefetch',
+                   dest='apt_prefetch',
+                   action='store_true',
+                   help="""\
+Download package archives in the background while the chroot is
+initialised.""")
+
+    a.add_argument('--apt-bulk',
+                   dest='apt_bulk',
+                   action='store_true',
+                   help="""\
+Install packages without fsync and with triggers deferred to a single pass.
+""")
+
     a.add_argument('--apt-conf',
                    metavar='<KEYWORD=VALUE>',
                    nargs='+',
@@ -193,6 +215,77 @@ Do not do trust verification of apt's sources.""")
 GPG Keyserver to fetch pubkeys from when securing apt.
 Default: wwwkeys.eu.pgp.net""")
 
+    a.add_argument('--apt-cache',
+                   dest='apt_cache_enable',
+                   action='store_true',
+                   help="""\
+Use and update the host's cache of downloaded package archives.
+""")
+
+    a.add_argument('--apt-cache-dir',
+                   dest='apt_cache_dir',
+                   metavar='<DIR>',
+                   help="""\
+Directory of the host's cache of downloaded package archives.
+Default: /var/cache/fll/archives""")
+
+    a.add_argument('--apt-mirror',
+                   dest='apt_mirror_mode',
+                   choices=['none', 'build', 'use'],
+                   metavar='<MODE>',
+                   help="""\
+Store installed packages in a local mirror (build) or install from it
+(use). Choices: %(choices)s.
+Default: none""")
+
+    a.add_argument('--apt-mirror-dir',
+                   dest='apt_mirror_dir',
+                   metavar='<DIR>',
+                   help="""\
+Directory of the local mirror.
+Default: /var/cache/fll/mirror""")
+
+    a.add_argument('--apt-fetch-queuemode',
+                   dest='apt_fetch_queuemode',
+                   choices=['host', 'access'],
+                   metavar='<MODE>',
+                   help="""\
+Open an apt download queue per host or per access method.
+Choices: %(choices)s.
+Default: apt's default""")
+
+    a.add_argument('--apt-fetch-parallel',
+                   dest='apt_fetch_parallel',
+                   type=int,
+                   metavar='<N>',
+                   help="""\
+Number of apt download queues which download at once.
+Default: apt's default""")
+
+    a.add_argument('--apt-fetch-pipeline',
+                   dest='apt_fetch_pipeline',
+                   type=int,
+                   metavar='<DEPTH>',
+                   help="""\
+Depth of HTTP pipelining, 0 to disable it.
+Default: apt's default""")
+
+    a.add_argument('--apt-fetch-retries',
+                   dest='apt_fetch_retries',
+                   type=int,
+                   metavar='<N>',
+                   help="""\
+Number of retries of a failed download.
+Default: apt's default""")
+
+    a.add_argument('--apt-fetch-slowest',
+                   dest='apt_fetch_slowest',
+                   type=int,
+                   metavar='<N>',
+                   help="""\
+Number of slowest downloads to list after each download run.
+Default: 5""")
+
     a.add_argument('--apt-quiet',
                    action='store_true',
                    help="""\
@@ -232,6 +325,37 @@ Package module directory path name.""")
                     help="""\
 List of package names to append to package profile.""")
 
+    pm.add_argument('--profile-variants',
+                    dest='profile_variants',
+                    nargs='+',
+                    metavar='<PROFILE>',
+                    help="""\
+Package profiles to build as variants of the base profile, each in an
+overlayfs layer on top of a shared base chroot.""")
+
+    pm.add_argument('--profile-locales',
+                    dest='profile_locales',
+                    nargs='+',
+                    metavar='<LOCALE>',
+                    help="""\
+Locales (e.g. en_US de_DE) for which locale support packages of the
+profile's packages are installed.""")
+
+    pm.add_argument('--profile-cache',
+                    dest='profile_cache_enable',
+                    action='store_true',
+                    help="""\
+Reuse the expanded package profile from the profile cache while its lists
+are unchanged.
+""")
+
+    pm.add_argument('--profile-cache-dir',
+                    dest='profile_cache_dir',
+                    metavar='<DIR>',
+                    help="""\
+Directory of the expanded package profile cache.
+Default: /var/cache/fll/profile""")
+
     c = p.add_argument_group(title='chroot related arguments')
 
     c.add_argument('--chroot-flavour',
@@ -278,12 +402,140 @@ Comma delimited list of packages to include during bootstrap.
 Comma delimited list of packages to exclude during bootstrap.
 """)
 
+    c.add_argument('--bootstrap-cache',
+                   dest='chroot_cache_enable',
+                   action='store_true',
+                   help="""\
+Reuse a cached bootstrap of identical parameters and store new bootstraps
+in the bootstrap cache.
+""")
+
+    c.add_argument('--bootstrap-cache-dir',
+                   dest='chroot_cache_dir',
+                   metavar='<DIR>',
+                   help="""\
+Directory of the bootstrap cache.
+Default: /var/cache/fll/bootstrap""")
+
+    c.add_argument('--chroot-diverts',
+                   dest='chroot_diverts',
+                   nargs='+',
+                   metavar='<FILE>',
+                   help="""\
+Additional files to divert and deny execution of while building the chroot.
+""")
+
+    c.add_argument('--chroot-server',
+                   dest='chroot_server',
+                   action='store_true',
+                   help="""\
+Execute chrooted commands via a small shell helper started in the chroot once.
+""")
+
+    c.add_argument('--hook-jobs',
+                   dest='chroot_hooks_jobs',
+                   type=int,
+                   metavar='<JOBS>',
+                   help="""\
+Number of hook items (e.g. initramfs per kernel) to run in parallel, 0 for
+the number of processors.
+Default: 0""")
+
+    c.add_argument('--hook-failfast',
+                   dest='chroot_hooks_failfast',
+                   action='store_true',
+                   help="""\
+Do not start any more hook items after one has failed.""")
+
+    c.add_argument('--mandb',
+                   dest='chroot_mandb_mode',
+                   choices=['sync', 'background', 'cached', 'skip'],
+                   metavar='<MODE>',
+                   help="""\
+Generation of the man-db index. Choices: %(choices)s.
+Default: sync""")
+
+    c.add_argument('--mandb-cache-dir',
+                   dest='chroot_mandb_dir',
+                   metavar='<DIR>',
+                   help="""\
+Directory of the man-db index cache used by --mandb cached.
+Default: /var/cache/fll/mandb""")
+
+    c.add_argument('--tmpfs',
+                   dest='chroot_tmpfs_enable',
+                   action='store_true',
+                   help="""\
+Build the chroot in memory, on a tmpfs which is grown as packages are
+installed. Falls back to disk if there is not enough memory.""")
+
+    c.add_argument('--tmpfs-size',
+                   dest='chroot_tmpfs_size',
+                   type=int,
+                   metavar='<MB>',
+                   help="""\
+Initial size of the tmpfs in MB.
+Default: 2048""")
+
+    c.add_argument('--tmpfs-reserve',
+                   dest='chroot_tmpfs_reserve',
+                   type=int,
+                   metavar='<MB>',
+                   help="""\
+Memory in MB to keep free in addition to the size of the tmpfs.
+Default: 1024""")
+
+    c.add_argument('--nuke-mode',
+                   dest='chroot_nuke_mode',
+                   choices=['sync', 'background'],
+                   metavar='<MODE>',
+                   help="""\
+Remove the chroot before continuing (sync), or in a detached process
+(background). Choices: %(choices)s.
+Default: sync""")
+
+    c.add_argument('--nuke-jobs',
+                   dest='chroot_nuke_jobs',
+                   type=int,
+                   metavar='<JOBS>',
+                   help="""\
+Number of threads which remove the chroot, 0 for the number of processors.
+Default: 0""")
+
+    c.add_argument('--nuke-rmtree',
+                   dest='chroot_nuke_rmtree',
+                   action='store_true',
+                   help="""\
+Remove the chroot file by file, even if it is a btrfs subvolume.""")
+
     c.add_argument('--chroot-preserve', '-P',
                    action='store_true',
                    help="""\
 Preserve chroot filesystem after completion.
 Default: False""")
 
+    c.add_argument('--checkpoint',
+                   dest='chroot_checkpoint_enable',
+                   action='store_true',
+                   help="""\
+Record each completed build stage and keep the chroot if the build fails,
+so that it may be resumed with --resume.""")
+
+    c.add_argument('--resume',
+                   dest='chroot_checkpoint_resume',
+                   action='store_true',
+                   help="""\
+Resume a failed build after its last completed stage, if the configuration
+has not changed.""")
+
+    c.add_argument('--checkpoint-snapshot',
+                   dest='chroot_checkpoint_snapshot',
+                   metavar='<MODE>',
+                   choices=['none', 'reflink'],
+                   help="""\
+Snapshot the chroot after each build stage. Choices: %(choices)s.
+Default: none""")
+
     c.add_argument('--chroot-quiet',
                    action='store_true',
                    help="""\
@@ -317,6 +569,15 @@ Default: chroot""")
                    choices=['mkfs', 'squashfs','tar','none'],
                    help="""\
 Select compression type. Choices: %(choices)s.
+Default: none""")
+
+    f.add_argument('--dedup',
+                   dest='fscomp_dedup',
+                   metavar='<MODE>',
+                   choices=['none', 'report', 'hardlink'],
+                   help="""\
+Report files of identical content before compression, or also hardlink
+those below usr/. Choices: %(choices)s.
 Default: none""")
 
     f.add_argument('--wrap',
@@ -330,11 +591,64 @@ Default: none""")
     f.add_argument('--squashfs-compressor',
                    dest='fscomp_squashfs_compressor',
                    metavar='<COMPRESSOR>',
-                   choices=['gzip', 'lzo', 'xz'],
+                   choices=['gzip', 'lzo', 'lz4', 'xz', 'zstd'],
                    help="""\
 Squashfs compression type. Choices: %(choices)s.
 Default: gzip""")
 
+    f.add_argument('--squashfs-processors',
+                   dest='fscomp_squashfs_processors',
+                   type=int,
+                   metavar='<NUM>',
+                   help="""\
+Number of processors used to create the squashfs, 0 for all available.
+Default: 0""")
+
+    f.add_argument('--squashfs-blocksize',
+                   dest='fscomp_squashfs_blocksize',
+                   metavar='<SIZE>',
+                   help="""\
+Squashfs block size (e.g. 128K, 1M).
+Default: mksquashfs default""")
+
+    f.add_argument('--squashfs-mem',
+                   dest='fscomp_squashfs_mem',
+                   metavar='<SIZE>',
+                   help="""\
+Memory budget of mksquashfs (e.g. 512M, 2G).
+Default: mksquashfs default""")
+
+    f.add_argument('--squashfs-level',
+                   dest='fscomp_squashfs_level',
+                   type=int,
+                   metavar='<LEVEL>',
+                   help="""\
+Squashfs compression level, 0 for the compressor default.
+Default: 0""")
+
+    f.add_argument('--squashfs-bcj',
+                   dest='fscomp_squashfs_bcj',
+                   metavar='<FILTER>',
+                   help="""\
+Branch/call/jump filter of the xz compressor, auto to select it by
+architecture or none to disable it.
+Default: auto""")
+
+    f.add_argument('--squashfs-delta',
+                   dest='fscomp_squashfs_delta',
+                   metavar='<FILE>',
+                   help="""\
+Write a squashfs of the changes since the previous build to FILE, to be
+mounted as an overlay on top of the previous images. Requires
+--squashfs-file, next to which a manifest of the build is kept.""")
+
+    f.add_argument('--squashfs-manifest',
+                   dest='fscomp_squashfs_manifest',
+                   metavar='<FILE>',
+                   help="""\
+Manifest of the previous build used by --squashfs-delta.
+Default: the squashfs file name with .manifest appended""")
+
     f.add_argument('--squashfs-file',
                    dest='fscomp_squashfs_file',
                    metavar='<FILE>',
@@ -345,11 +659,26 @@ Default: ''""")
     f.add_argument('--tar-compressor',
                    dest='fscomp_tar_compressor',
                    metavar='<COMPRESSOR>',
-                   choices=['gz', 'bz', 'pz', 'xz'],
+                   choices=['gz', 'bz', 'pz', 'xz', 'zstd'],
                    help="""\
 Tar compression type. Choices: %(choices)s.
 Default: gzip""")
 
+    f.add_argument('--tar-stream',
+                   dest='fscomp_tar_stream',
+                   action='store_true',
+                   help="""\
+Stream tar output through a parallel compressor straight to the output file.
+Default: False""")
+
+    f.add_argument('--tar-threads',
+                   dest='fscomp_tar_threads',
+                   type=int,
+                   metavar='<NUM>',
+                   help="""\
+Number of compressor threads when streaming, 0 for all available.
+Default: 0""")
+
     f.add_argument('--tar-file',
                    dest='fscomp_tar_file',
                    metavar='<FILE>',
@@ -365,6 +694,16 @@ Default: ''""")
 Mkfs filesystem type. Choices: %(choices)s.
 Default: ext2""")
 
+    f.add_argument('--mkfs-engine',
+                   dest='fscomp_mkfs_engine',
+                   metavar='<ENGINE>',
+                   choices=['populate', 'rsync'],
+                   help="""\
+Mkfs engine. populate creates the image directly from the chroot with
+mkfs -d, rsync copies the chroot into a loop mounted image. Choices:
+%(choices)s.
+Default: rsync""")
+
     f.add_argument('--mkfs-size',
                    dest='fscomp_mkfs_size',
                    type=int,
@@ -599,7 +938,8 @@ class Config(object):
         debug = args.verbosity == 'debug'
 
         for key, value in args.__dict__.iteritems():
-            if value in [None, False]:
+            # 0 == False, but an integer argument of 0 must be merged.
+            if value is None or value is False:
                 continue
             if isinstance(value, file):
                 continue
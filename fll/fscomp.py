@@ -8,17 +8,38 @@ Copyright: Copyright (C) 2013-2014 Niall Walsh <niallwalsh@celtux.org>
 License:   GPL-2
 """
 
+import fll.cache
 import fll.misc
+import fnmatch
+import json
+import multiprocessing
 import os
 import shutil
+import stat
+import subprocess
+import tempfile
+import threading
 import time
+import Queue
 
 class FsCompError(Exception):
     pass
 
 
 class FsComp(object):
-    taropt = dict( gz='-z', bz='-j', xz='-J', pz='-Ipixz' )
+    taropt = dict( gz='-z', bz='-j', xz='-J', pz='-Ipixz', zstd='--zstd' )
+    # parallel compressors which tar output is streamed through, the
+    # package providing them and their option for the number of threads
+    tarpipe = dict( gz=['pigz', '-c'], bz=['pbzip2', '-c'],
+                    xz=['xz', '-c'], pz=['pixz'], zstd=['zstd', '-q', '-c'] )
+    tarpkgs = dict( gz='pigz', bz='pbzip2', xz='xz-utils', pz='pixz',
+                    zstd='zstd' )
+    tarthreads = dict( gz='-p%i', bz='-p%i', xz='-T%i', pz='-p%i',
+                       zstd='-T%i' )
+    # xz branch/call/jump filters to apply for each Debian architecture
+    bcj = dict( amd64='x86', i386='x86', armel='arm', armhf='armthumb',
+                arm64='arm64', powerpc='powerpc', ppc64='powerpc',
+                sparc='sparc', sparc64='sparc', ia64='ia64' )
     excludes = [ 'etc/.*lock', 'etc/*-', 'etc/adjtime', 'etc/apt/*~',
                  'etc/blkid.tab', 'etc/console-setup/*.gz', 'etc/localtime',
                  'etc/lvm/archive', 'etc/lvm/backup', 'etc/lvm/cache',
@@ -31,6 +52,10 @@ class FsComp(object):
                  'var/lib/alsa/asound.state', 'var/lib/apt/extended_states',
                  'var/lib/apt/lists/*_dists_*', 'var/lib/dbus/machine-id',
                  'var/lib/dpkg/*-old', 'var/run/*' ]
+    # trees which are not modified on the installed system, so duplicates
+    # within them may share an inode. files of etc/ and var/ may be edited
+    # in place, which would change every hardlink of them.
+    linkdirs = [ 'usr' ]
     def __init__(self, chroot=None,config={}):
         self.chroot=chroot
         self.config=config
@@ -39,23 +64,149 @@ class FsComp(object):
         self.ts=''
         if (self.config['compression'] == 'squashfs'):
             self.depends.append('squashfs-tools')
-        elif (self.config['compression'] == 'mkfs'):
+        elif (self.config['compression'] == 'mkfs' and
+              self.config['mkfs']['engine'] == 'rsync'):
             self.depends.append('rsync')
+        elif (self.config['compression'] == 'tar' and
+              self.config['tar']['stream']):
+            self.depends.append(self.tarpkgs[self.config['tar']['compressor']])
         if (('wrap' in self.config) and ('iso' in self.config['wrap'])):
             # ,'grub-efi-amd64-bin','grub-efi-ia32-bin'
             self.depends.extend(['grub-pc','xorriso'])
 
     def compress(self):
         """create whatever is set for compression and wrap it"""
-        # create the stamp file to identify the fs
-        self.stamp()
-        if (self.config['compression'] == 'squashfs'):
-            self.squash()
-        elif (self.config['compression'] == 'tar'):
-            self.tar()
-        elif (self.config['compression'] == 'mkfs'):
-            self.mkfs()
-        self.wrap()
+        try:
+            if (self.config['dedup'] != 'none'):
+                self.dedup()
+            # create the stamp file to identify the fs
+            self.stamp()
+            if (self.config['compression'] == 'squashfs'):
+                self.squash()
+            elif (self.config['compression'] == 'tar'):
+                self.tar()
+            elif (self.config['compression'] == 'mkfs'):
+                self.mkfs()
+            self.wrap()
+        except (OSError, IOError), e:
+            raise FsCompError('compression failed: %s' % e)
+
+    def persist(self, dirname):
+        """move outputs which were written inside the chroot to dirname"""
+        for i, output in enumerate(self.output):
+            path = output
+            if (not os.path.isabs(output) and not os.path.exists(output)):
+                path = self.chroot.chroot_path(output)
+            path = os.path.realpath(path)
+            if (not path.startswith(self.chroot.rootdir + '/')):
+                continue
+            target = os.path.join(dirname, os.path.basename(path))
+            print 'FSCOMP %s -> %s' % (path, target)
+            try:
+                shutil.move(path, target)
+            except (OSError, IOError), e:
+                raise FsCompError('failed to move %s: %s' % (path, e))
+            self.output[i] = target
+
+    def dedup(self):
+        """find regular files of identical content in the chroot, report
+        the bytes taken by duplicates and the packages which own them, and
+        with dedup=hardlink replace the duplicates within linkdirs with
+        hardlinks"""
+        compression = self.config['compression']
+        excludes = self.excludelist(self.config.get(compression, {}))
+        # only files of the same size, mode and owner can share an inode
+        groups = dict()
+        inodes = set()
+        for path, st, excluded in self.scan(excludes):
+            if (excluded or not stat.S_ISREG(st.st_mode) or
+                st.st_size == 0 or (st.st_dev, st.st_ino) in inodes):
+                continue
+            inodes.add((st.st_dev, st.st_ino))
+            key = (st.st_size, st.st_mode, st.st_uid, st.st_gid, st.st_dev)
+            groups.setdefault(key, list()).append(path)
+        candidates = [ (key, paths) for key, paths in groups.iteritems()
+                       if len(paths) > 1 ]
+
+        # hash the candidates in parallel, hashlib releases the GIL
+        queue = Queue.Queue()
+        for key, paths in candidates:
+            for path in paths:
+                queue.put((key, path))
+        digests = dict()
+        lock = threading.Lock()
+        def worker():
+            while True:
+                try:
+                    key, path = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                digest = fll.cache.checksum(path, 'sha1')
+                lock.acquire()
+                digests.setdefault((key, digest), list()).append(path)
+                lock.release()
+        threads = [ threading.Thread(target=worker)
+                    for n in range(multiprocessing.cpu_count()) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        duplicates = [ (key[0][0] * (len(paths) - 1), sorted(paths))
+                       for key, paths in digests.iteritems()
+                       if len(paths) > 1 ]
+        duplicates.sort(reverse=True)
+        wasted = sum([ d[0] for d in duplicates ])
+        print 'FSCOMP dedup: %i groups, %i duplicate files, %.1fMB' % \
+            (len(duplicates), sum([ len(d[1]) - 1 for d in duplicates ]),
+             wasted/2.0**20)
+
+        owners = self.owners(set([ p for d in duplicates for p in d[1] ]))
+        pkgbytes = dict()
+        for size, paths in duplicates:
+            for path in paths[1:]:
+                pkg = owners.get(path, '-')
+                pkgbytes[pkg] = pkgbytes.get(pkg, 0) + size / (len(paths) - 1)
+        for size, paths in duplicates[:10]:
+            print 'FSCOMP dedup %.1fMB: %s' % (size/2.0**20, ' '.join(
+                [ '%s(%s)' % (self.chroot.chroot_path_rel(p),
+                              owners.get(p, '-')) for p in paths ]))
+        for pkg, size in sorted(pkgbytes.iteritems(), key=lambda i: i[1],
+                                reverse=True)[:10]:
+            print 'FSCOMP dedup package %s: %.1fMB' % (pkg, size/2.0**20)
+
+        if (self.config['dedup'] != 'hardlink'):
+            return
+        linkdirs = [ self.chroot.chroot_path(d) + os.sep
+                     for d in self.linkdirs ]
+        linked = 0
+        for size, paths in duplicates:
+            filesize = size / (len(paths) - 1)
+            paths = [ p for p in paths
+                      if ([ d for d in linkdirs if p.startswith(d) ]) ]
+            for path in paths[1:]:
+                tmp = '%s.dedup' % path
+                os.link(paths[0], tmp)
+                os.rename(tmp, path)
+                linked += filesize
+        print 'FSCOMP dedup: hardlinked %.1fMB' % (linked/2.0**20)
+
+    def owners(self,paths):
+        """map each of paths to the package which owns it, according to the
+        file lists in the dpkg database of the chroot"""
+        owners = dict()
+        info = self.chroot.chroot_path('/var/lib/dpkg/info')
+        if (not os.path.isdir(info)):
+            return(owners)
+        for name in fnmatch.filter(os.listdir(info), '*.list'):
+            pkg = name[:-len('.list')]
+            fh = open(os.path.join(info, name))
+            for line in fh:
+                path = self.chroot.chroot_path(line.rstrip('\n'))
+                if (path in paths):
+                    owners[path] = pkg
+            fh.close()
+        return(owners)
 
     def squash(self):
         """create a squashfs file of the chroot"""
@@ -66,17 +217,204 @@ class FsComp(object):
             output = filename
         else:
             filename = 'tmp/squash'
-        cmd = [ 'mksquashfs', '.', filename, '-comp', config['compressor'] ]
-        if (config['compressor'] == 'xz'):
-            cmd.extend('-Xbcj', 'x86')
+        if (config['delta'] and output != None):
+            if (self.squashdelta(config, filename)):
+                self.output.append(config['delta'])
+                return
+        cmd = [ 'mksquashfs', '.', filename ] + self.squashopts(config)
         cmd.extend(['-wildcards', '-ef', self.excludesfile(config,filename)])
+        start = time.time()
         self.chroot.cmd(cmd)
+        self.timing('squashfs', self.chroot.chroot_path(filename),
+                    time.time() - start,
+                    [ '%s=%s' % (k, config[k]) for k in
+                      ['compressor', 'processors', 'blocksize', 'mem',
+                       'level', 'bcj'] ])
         if (output != None):
             shutil.move(self.chroot.chroot_path(filename),output)
             self.output.append(output)
+            if (config['delta']):
+                self.writemanifest(config, self.manifest(config, filename))
         else:
             self.output.append(filename)
 
+    def squashopts(self,config):
+        """mksquashfs compression options of the squashfs config"""
+        cmd = [ '-comp', config['compressor'] ]
+        if (config['processors'] > 0):
+            cmd.extend(['-processors', '%i' % config['processors']])
+        if (len(config['blocksize']) > 0):
+            cmd.extend(['-b', config['blocksize']])
+        if (len(config['mem']) > 0):
+            cmd.extend(['-mem', config['mem']])
+        if (config['level'] > 0):
+            if (config['compressor'] in ['gzip', 'lzo', 'zstd']):
+                cmd.extend(['-Xcompression-level', '%i' % config['level']])
+            elif (config['compressor'] == 'lz4'):
+                cmd.append('-Xhc')
+        if (config['compressor'] == 'xz'):
+            bcj = config['bcj']
+            if (bcj == 'auto'):
+                bcj = self.bcj.get(self.chroot.architecture, 'none')
+            if (bcj != 'none'):
+                cmd.extend(['-Xbcj', bcj])
+        return(cmd)
+
+    def manifestfile(self,config):
+        """filename of the manifest of the previous squashfs build"""
+        if (len(config['manifest']) > 0):
+            return(config['manifest'])
+        return(config['file'] + '.manifest')
+
+    def manifest(self,config,filename,previous={}):
+        """map each path of the chroot which is not excluded to its type,
+        metadata and, for regular files, sha1 checksum. The checksum of a
+        file whose size and mtime are unchanged since the previous manifest
+        is reused."""
+        excludes = self.excludelist(config)
+        excludes.append(filename)
+        rootdir = self.chroot.rootdir
+        manifest = dict()
+        for path, st, excluded in self.scan(excludes):
+            if (excluded):
+                continue
+            relpath = os.path.relpath(path, rootdir)
+            meta = [ st.st_mode, st.st_uid, st.st_gid ]
+            if (stat.S_ISREG(st.st_mode)):
+                old = previous.get(relpath)
+                if (old != None and old[0] == 'f' and
+                    old[1:3] == [ st.st_size, st.st_mtime ]):
+                    sha1 = old[3]
+                else:
+                    sha1 = fll.cache.checksum(path, 'sha1')
+                entry = [ 'f', st.st_size, st.st_mtime, sha1 ] + meta
+            elif (stat.S_ISLNK(st.st_mode)):
+                entry = [ 'l', os.readlink(path) ] + meta
+            elif (stat.S_ISDIR(st.st_mode)):
+                entry = [ 'd' ] + meta
+            else:
+                entry = [ 'o', st.st_rdev ] + meta
+            manifest[relpath] = entry
+        return(manifest)
+
+    def writemanifest(self,config,manifest):
+        """write the manifest of this build for the next delta build. paths
+        are byte strings of any encoding, they are stored as latin-1 so that
+        each byte maps to one character."""
+        fname = self.manifestfile(config)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)),
+                                   prefix='.')
+        try:
+            fh = os.fdopen(fd, 'w')
+            json.dump(manifest, fh, encoding='latin-1')
+            fh.close()
+            os.chmod(tmp, 0644)
+            os.rename(tmp, fname)
+        finally:
+            if (os.path.exists(tmp)):
+                os.unlink(tmp)
+
+    def loadmanifest(self,config):
+        """load the manifest of the previous build, with the strings
+        converted back to the byte strings written by writemanifest()"""
+        def decode(value):
+            if (isinstance(value, unicode)):
+                return(value.encode('latin-1'))
+            return(value)
+
+        fh = open(self.manifestfile(config))
+        try:
+            manifest = json.load(fh)
+        except ValueError, e:
+            raise FsCompError('invalid manifest %s: %s' %
+                              (self.manifestfile(config), e))
+        finally:
+            fh.close()
+        return(dict([ (decode(path), [ decode(v) for v in entry ])
+                      for path, entry in manifest.iteritems() ]))
+
+    def squashdelta(self,config,filename):
+        """create a squashfs of the changes since the previous build, to be
+        mounted as an overlay on top of the previous images. Changed and
+        added paths are hardlinked into a staging tree, removed paths are
+        represented by overlayfs whiteouts. Return False if there is no
+        manifest of a previous build."""
+        fname = self.manifestfile(config)
+        if (not os.path.isfile(fname)):
+            print 'FSCOMP no manifest %s, building full image' % fname
+            return(False)
+        previous = self.loadmanifest(config)
+        current = self.manifest(config, filename, previous)
+
+        staging = 'tmp/delta'
+        stagedir = self.chroot.chroot_path(staging)
+        if (os.path.exists(stagedir)):
+            shutil.rmtree(stagedir)
+        os.mkdir(stagedir)
+
+        rootdir = self.chroot.rootdir
+        changed = [ p for p in sorted(current)
+                    if current[p] != previous.get(p) ]
+        removed = [ p for p in sorted(previous) if p not in current ]
+        gone = set(removed)
+        size = 0
+        total = 0
+        for entry in current.itervalues():
+            if (entry[0] == 'f'):
+                total += entry[1]
+        for relpath in changed:
+            self.stagepath(rootdir, stagedir, relpath)
+            if (current[relpath][0] == 'f'):
+                size += current[relpath][1]
+        for relpath in removed:
+            parent = os.path.dirname(relpath)
+            if (parent in gone):
+                continue
+            if (len(parent) > 0):
+                self.stagepath(rootdir, stagedir, parent)
+            os.mknod(os.path.join(stagedir, relpath), stat.S_IFCHR,
+                     os.makedev(0, 0))
+        print 'FSCOMP delta: %i changed, %i removed, %.1fMB of %.1fMB' % \
+            (len(changed), len(removed), size/2.0**20, total/2.0**20)
+
+        cmd = [ 'mksquashfs', staging, filename ] + self.squashopts(config)
+        start = time.time()
+        self.chroot.cmd(cmd)
+        self.timing('squashfs-delta', self.chroot.chroot_path(filename),
+                    time.time() - start,
+                    [ '%s=%s' % (k, config[k]) for k in
+                      ['compressor', 'processors', 'blocksize', 'mem',
+                       'level', 'bcj'] ])
+        shutil.move(self.chroot.chroot_path(filename), config['delta'])
+        shutil.rmtree(stagedir)
+        self.writemanifest(config, current)
+        return(True)
+
+    def stagepath(self,rootdir,stagedir,relpath):
+        """recreate relpath of rootdir in stagedir, with its parents. Files
+        are hardlinked, directories, symlinks and special files are created
+        with the same metadata."""
+        parent = os.path.dirname(relpath)
+        if (len(parent) > 0 and
+            not os.path.isdir(os.path.join(stagedir, parent))):
+            self.stagepath(rootdir, stagedir, parent)
+        src = os.path.join(rootdir, relpath)
+        dst = os.path.join(stagedir, relpath)
+        if (os.path.lexists(dst)):
+            return
+        st = os.lstat(src)
+        if (stat.S_ISREG(st.st_mode)):
+            os.link(src, dst)
+            return
+        if (stat.S_ISDIR(st.st_mode)):
+            os.mkdir(dst)
+            os.chmod(dst, stat.S_IMODE(st.st_mode))
+        elif (stat.S_ISLNK(st.st_mode)):
+            os.symlink(os.readlink(src), dst)
+        else:
+            os.mknod(dst, st.st_mode, st.st_rdev)
+        os.lchown(dst, st.st_uid, st.st_gid)
+
     def tar(self):
         """create a tar of the chroot"""
         config = self.config['tar']
@@ -88,7 +426,9 @@ class FsComp(object):
             filename = 'tmp/rootfs.tar'
             if ('compressor' in config):
                 filename = '%s.%s' % (filename, config['compressor'])
-                output = '%s.%s' % (output, config['compressor'])
+        if (config['stream']):
+            self.tarstream(config, filename, output)
+            return
         self.chroot.cmd([ 'tar',
                           '-c', "%s" % self.taropt[config['compressor']],
                           '-f', filename,
@@ -99,6 +439,43 @@ class FsComp(object):
         else:
             self.output.append(filename)
 
+    def tarstream(self,config,filename,output):
+        """stream tar output through a parallel compressor straight to
+        the final output file"""
+        comp = list(self.tarpipe[config['compressor']])
+        if (config['threads'] > 0 or config['compressor'] in ['xz', 'zstd']):
+            comp.append(self.tarthreads[config['compressor']] %
+                        config['threads'])
+        cmd = [ 'tar', '-c', '-f', '-',
+                '-X', self.excludesfile(config,filename), '.' ]
+        if (output != None):
+            path = output
+        else:
+            path = self.chroot.chroot_path(filename)
+        print 'CHROOT %s %s | %s > %s' % (self.chroot.rootdir,
+                                         ' '.join(cmd), ' '.join(comp), path)
+        start = time.time()
+        fh = open(path, 'wb')
+        try:
+            tar = self.chroot.popen(cmd, stdout=subprocess.PIPE)
+            compressor = self.chroot.popen(comp, stdin=tar.stdout, stdout=fh)
+            tar.stdout.close()
+            compressor.wait()
+            tar.wait()
+        finally:
+            fh.close()
+        if (tar.returncode != 0 or compressor.returncode != 0):
+            os.unlink(path)
+            raise FsCompError('tar stream failed: tar=%d %s=%d' %
+                              (tar.returncode, comp[0], compressor.returncode))
+        self.timing('tar', path, time.time() - start,
+                    [ '%s=%s' % (k, config[k]) for k in
+                      ['compressor', 'threads'] ])
+        if (output != None):
+            self.output.append(output)
+        else:
+            self.output.append(filename)
+
     def mkfs(self):
         """create a filesystem image of the chroot"""
         config = self.config['mkfs']
@@ -108,6 +485,9 @@ class FsComp(object):
             output = filename
         else:
             filename = 'tmp/rootfs'
+        if (config['engine'] == 'populate'):
+            self.mkfspopulate(config, filename, output)
+            return
         self.chroot.cmd([ 'dd', 'if=/dev/zero',
                           'of=%s' % filename,
                           'bs=1',
@@ -135,14 +515,117 @@ class FsComp(object):
         else:
             self.output.append(filename)
 
-    def excludesfile(self,config,filename):
+    def mkfspopulate(self,config,filename,output):
+        """create a filesystem image populated by mkfs from a staging tree
+        of the chroot, sized from a scan of the chroot. excluded paths are
+        never staged, so their data can not end up in the image."""
+        staging = 'tmp/mkfs'
+        excludes = self.excludelist(config)
+        excludes.extend([ staging, filename ])
+        rootdir = self.chroot.rootdir
+        stagedir = self.chroot.chroot_path(staging)
+        if (os.path.exists(stagedir)):
+            shutil.rmtree(stagedir)
+        os.mkdir(stagedir)
+        st = os.lstat(rootdir)
+        os.chmod(stagedir, stat.S_IMODE(st.st_mode))
+        os.lchown(stagedir, st.st_uid, st.st_gid)
+
+        blocksize = 4096
+        inodes = 0
+        nbytes = 0
+        seen = set()
+        dirs = list()
+        for path, st, excluded in self.scan(excludes):
+            if (excluded):
+                continue
+            relpath = os.path.relpath(path, rootdir)
+            self.stagepath(rootdir, stagedir, relpath)
+            if (stat.S_ISDIR(st.st_mode)):
+                dirs.append((relpath, st))
+            inodes += 1
+            if (st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode)):
+                if st.st_ino in seen:
+                    continue
+                seen.add(st.st_ino)
+            nbytes += (st.st_size + blocksize - 1) // blocksize * blocksize
+        # directories were modified by staging their contents
+        for relpath, st in reversed(dirs):
+            os.utime(os.path.join(stagedir, relpath),
+                     (st.st_atime, st.st_mtime))
+        inodes += inodes // 10 + 1024
+        nbytes += inodes * 256
+        # factor is %, plus room for the journal and fs metadata
+        size = nbytes * config['factor'] // 100 + 64 * 2**20
+        image = self.chroot.rootdir + '.mkfs'
+        fh = open(image, 'wb')
+        fh.truncate(size)
+        fh.close()
+        try:
+            fll.misc.cmd([ 'mkfs', '-t', config['type'], '-F', '-q',
+                           '-b', '%i' % blocksize, '-m', '0',
+                           '-N', '%i' % inodes,
+                           '-d', stagedir, image ])
+            if (output == None):
+                output = self.chroot.chroot_path(filename)
+            shutil.move(image, output)
+        finally:
+            if (os.path.exists(image)):
+                os.unlink(image)
+            shutil.rmtree(stagedir)
+        if (len(config['file']) > 0):
+            self.output.append(output)
+        else:
+            self.output.append(filename)
+
+    def excludelist(self,config):
         """only the most specific excludes are used
         type config, class config, class data in that order """
-        excludes=self.excludes
+        excludes = list(self.excludes)
         if 'exclude' in config:
-            excludes = config['exclude']
+            excludes = list(config['exclude'])
         elif 'exclude' in self.config:
-            excludes = self.config['exclude']
+            excludes = list(self.config['exclude'])
+        return(excludes)
+
+    def scan(self,excludes):
+        """walk the chroot yielding (path, lstat, excluded) for each entry
+        below it. Excluded directories are not descended into."""
+        rootdir = self.chroot.rootdir
+        for root, dirs, files in os.walk(rootdir):
+            rel = os.path.relpath(root, rootdir)
+            keep = list()
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                if (rel == '.'):
+                    relpath = name
+                else:
+                    relpath = os.path.join(rel, name)
+                st = os.lstat(path)
+                excluded = self.excluded(relpath, excludes)
+                yield (path, st, excluded)
+                if (name in dirs and not excluded):
+                    keep.append(name)
+            dirs[:] = keep
+
+    def excluded(self,relpath,excludes):
+        """whether relpath matches any of the exclude wildcards"""
+        for pattern in excludes:
+            if (fnmatch.fnmatch(relpath, pattern)):
+                return(True)
+        return(False)
+
+    def timing(self,name,path,duration,settings):
+        """report how long it took to create path, and the settings used,
+        so settings may be compared for speed and size"""
+        size = os.path.getsize(path)
+        print 'FSCOMP %s %s: %.1fMB in %.1fs (%.1fMB/s)' % \
+            (name, ' '.join(settings), size/2.0**20, duration,
+             size/2.0**20/max(duration, 0.001))
+
+    def excludesfile(self,config,filename):
+        """write the exclude list for filename to a file in the chroot"""
+        excludes = self.excludelist(config)
         excludes.append(filename)
         xfile='tmp/excludes'
         fh = open(self.chroot.chroot_path(xfile), 'w')
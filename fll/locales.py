@@ -1,6 +1,6 @@
 """
 This is the fll.locales module, it provides a class for detecting
-locale support packages given a list/dict of packages, apt_pkg cache
+locale support packages given a list/dict of packages, apt cache
 object and a dict of package -> locale package name prefix strings.
 
 Author:    Kel Modderman
@@ -45,7 +45,7 @@ class FllLocales(object):
     Debian packages using it's detect_locale_packages method.
 
     Arguments:
-    cache    - an apt_pkg cache object
+    cache    - an apt.cache.Cache object
     packages - a list or dict of package names which are installed, or are
                going to be installed. Locale specific packages are selected
                for packages in this data structure.
@@ -56,27 +56,29 @@ class FllLocales(object):
     """
     def __init__(self, cache, packages, map):
         self.loc_pkgs_set = set()
-        for pkg in cache.packages:
-            if not pkg.version_list:
-                continue
-            if pkg.name not in packages:
-                continue
-            for loc_pkg in map.keys():
-                if pkg.name == loc_pkg:
-                    loc_pkg_prefix_list = map.get(loc_pkg)
-                    for loc_pkg_prefix in loc_pkg_prefix_list:
-                        self.loc_pkgs_set.add(loc_pkg_prefix)
-                    break
+        names = list()
+        # apt.cache.Cache only lists packages which have versions
+        for name in cache.keys():
+            names.append(name)
+            if name in packages and name in map:
+                self.loc_pkgs_set.update(map.get(name))
+
+        # Index locale support packages by prefix and then by suffix, so
+        # that each locale is resolved with a dict lookup per suffix.
+        self.loc_pkgs_index = dict()
+        for loc_pkg in self.loc_pkgs_set:
+            self.loc_pkgs_index[loc_pkg] = dict()
+        for name in names:
+            idx = name.find('-')
+            while idx > 0:
+                prefix = name[:idx]
+                if prefix in self.loc_pkgs_index:
+                    self.loc_pkgs_index[prefix][name[idx + 1:]] = name
+                idx = name.find('-', idx + 1)
 
         self.loc_pkgs_list_dict = dict()
-        for loc_pkg in self.loc_pkgs_set:
-            self.loc_pkgs_list_dict[loc_pkg] = list()
-        for pkg in cache.packages:
-            if not pkg.version_list:
-                continue
-            for loc_pkg in self.loc_pkgs_set:
-                if pkg.name.startswith(loc_pkg + '-'):
-                    self.loc_pkgs_list_dict[loc_pkg].append(pkg.name)
+        for loc_pkg, suffixes in self.loc_pkgs_index.iteritems():
+            self.loc_pkgs_list_dict[loc_pkg] = suffixes.values()
 
     def __compute_locale_loc_suf_list(self, locale):
         """
@@ -126,24 +128,28 @@ class FllLocales(object):
         """
         suffixes = self.__compute_locale_loc_suf_list(locale)
 
-        loc_pkg_dict = dict()
-        for pkg in self.loc_pkgs_set:
-            loc_pkgs_list = self.loc_pkgs_list_dict.get(pkg)
-            if not loc_pkgs_list:
-                continue
-            if pkg not in loc_pkg_dict:
-                loc_pkg_dict[pkg] = dict()
-            for loc_pkg in loc_pkgs_list:
-                for idx, suf in enumerate(suffixes):
-                    if loc_pkg == '-'.join([pkg, suf]):
-                       loc_pkg_dict[pkg][idx] = loc_pkg
-
         packages = list()
         for pkg in self.loc_pkgs_set:
-            pkg_candidates = loc_pkg_dict.get(pkg)
-            if not pkg_candidates:
+            candidates = self.loc_pkgs_index.get(pkg)
+            if not candidates:
                 continue
-            best = min(pkg_candidates)
-            packages.append(pkg_candidates[best])
+            for suf in suffixes:
+                if suf in candidates:
+                    packages.append(candidates[suf])
+                    break
 
         return packages
+
+    def detect_locales_packages(self, locales):
+        """
+        Return a dict which maps each locale string of locales to the list
+        of package names returned by detect_locale_packages for it.
+
+        Arguments:
+        locales - a list of locale strings (eg. [en_AU, pt_PT])
+        """
+        result = dict()
+        for locale in locales:
+            if locale not in result:
+                result[locale] = self.detect_locale_packages(locale)
+        return result
@@ -1,9 +1,19 @@
+import ctypes
+import ctypes.util
+import errno
+import fll.report
 import shlex
+import select
+import shutil
 import signal
+import stat
 import subprocess
 import os
 import pprint
 import sys
+import threading
+import traceback
+import Queue
 
 def debug(mode, title, obj):
     if mode is False:
@@ -20,6 +30,117 @@ def restore_sigpipe():
     SIGPIPE restored to default (http://bugs.python.org/issue1652)."""
     signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
+_libc = None
+
+MS_REMOUNT = 32
+
+def _libc_call(function, path, *args):
+    """Call a function of the C library which operates on path. Raise
+    OSError on failure."""
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    if getattr(_libc, function)(*args) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, '%s %s: %s' % (function, path, os.strerror(e)))
+
+def mount(source, target, fstype, flags=0, data=None):
+    """Mount a filesystem with the mount(2) system call, avoiding the cost
+    of forking mount(8)."""
+    _libc_call('mount', target, source, target, fstype,
+               ctypes.c_ulong(flags), data)
+
+def umount(target, flags=0):
+    """Unmount a filesystem with the umount2(2) system call."""
+    _libc_call('umount2', target, target, flags)
+
+def meminfo(key):
+    """Return the value of a field of /proc/meminfo in bytes, or 0 if it is
+    not present."""
+    with open('/proc/meminfo') as fh:
+        for line in fh:
+            name, value = line.split(':', 1)
+            if name == key:
+                return int(value.split()[0]) * 1024
+    return 0
+
+def fstype(path):
+    """Return the type of the filesystem which path is on, as listed in
+    /proc/mounts."""
+    path = os.path.realpath(path)
+    found = ('', None)
+    with open('/proc/mounts') as mounts:
+        for line in mounts:
+            mnt, vfstype = line.split()[1:3]
+            if path == mnt or path.startswith(mnt.rstrip('/') + '/'):
+                if len(mnt) >= len(found[0]):
+                    found = (mnt, vfstype)
+    return found[1]
+
+def rmtree(path, jobs=1):
+    """Remove a directory tree. With more than one job, files are unlinked
+    by that many threads, which share a queue of the directories to list,
+    and the remaining tree of empty directories is removed last."""
+    if jobs < 2:
+        shutil.rmtree(path)
+        return
+
+    queue = Queue.Queue()
+    queue.put(path)
+
+    def worker():
+        while True:
+            dirname = queue.get()
+            if dirname is None:
+                return
+            try:
+                for name in os.listdir(dirname):
+                    fname = os.path.join(dirname, name)
+                    if stat.S_ISDIR(os.lstat(fname).st_mode):
+                        queue.put(fname)
+                    else:
+                        os.unlink(fname)
+            except OSError:
+                # left for the final shutil.rmtree() to report
+                pass
+            finally:
+                queue.task_done()
+
+    threads = [threading.Thread(target=worker) for n in range(jobs)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    queue.join()
+    for thread in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+
+    shutil.rmtree(path)
+
+def detach(function, *args):
+    """Run function in a detached grandchild process, with its standard
+    streams redirected to /dev/null, and return without waiting for it."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            if os.fork() == 0:
+                os.setsid()
+                null = os.open(os.devnull, os.O_RDWR)
+                for fd in (0, 1, 2):
+                    os.dup2(null, fd)
+                os.closerange(3, subprocess.MAXFD)
+                try:
+                    function(*args)
+                finally:
+                    os._exit(0)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
 def cmd(cmd, pipe=False, quiet=False, silent=False):
     """Execute a command."""
     if isinstance(cmd, str):
@@ -31,18 +152,19 @@ def cmd(cmd, pipe=False, quiet=False, silent=False):
     devnull = output = None
 
     try:
-        if pipe:
-            proc = subprocess.Popen(cmd, preexec_fn=restore_sigpipe,
-                                    stdout=subprocess.PIPE)
-            output = proc.communicate()[0]
-        elif quiet or silent:
-            devnull = os.open(os.devnull, os.O_RDWR)
-            proc = subprocess.Popen(cmd, preexec_fn=restore_sigpipe,
-                                    stdout=devnull)
-            proc.wait()
-        else:
-            proc = subprocess.Popen(cmd, preexec_fn=restore_sigpipe)
-            proc.wait()
+        with fll.report.command(cmd):
+            if pipe:
+                proc = subprocess.Popen(cmd, preexec_fn=restore_sigpipe,
+                                        stdout=subprocess.PIPE)
+                output = proc.communicate()[0]
+            elif quiet or silent:
+                devnull = os.open(os.devnull, os.O_RDWR)
+                proc = subprocess.Popen(cmd, preexec_fn=restore_sigpipe,
+                                        stdout=devnull)
+                proc.wait()
+            else:
+                proc = subprocess.Popen(cmd, preexec_fn=restore_sigpipe)
+                proc.wait()
     except OSError, e:
         raise OSError('command failed: %s' % e)
     finally:
@@ -55,3 +177,83 @@ def cmd(cmd, pipe=False, quiet=False, silent=False):
 
     if pipe:
         return output
+
+def parallel(tasks, jobs=1):
+    """Run each (label, function, args) tuple of tasks in a separate child
+    process, at most jobs at a time. Every line written to stdout or stderr
+    by a task, or by any command it executes, is prefixed with its label.
+    Return a dict which maps each label to the exit status of its task."""
+    pending = list(tasks)
+    running = dict()
+    status = dict()
+
+    def spawn(label, function, args):
+        r, w = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            os.dup2(w, sys.stdout.fileno())
+            os.dup2(w, sys.stderr.fileno())
+            os.close(w)
+            # Line buffered, so output is not reordered relative to the
+            # output of any subprocess.
+            sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 1)
+            sys.stderr = os.fdopen(sys.stderr.fileno(), 'w', 0)
+            retv = 1
+            try:
+                function(*args)
+                retv = 0
+            except SystemExit, e:
+                if e.code is None:
+                    retv = 0
+                elif isinstance(e.code, int):
+                    retv = e.code
+                else:
+                    print >>sys.stderr, e.code
+            except:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(retv)
+        os.close(w)
+        running[r] = [label, pid, '']
+
+    def emit(label, line):
+        print '[%s] %s' % (label, line)
+        sys.stdout.flush()
+
+    while pending or running:
+        while pending and len(running) < jobs:
+            spawn(*pending.pop(0))
+
+        try:
+            ready, _, _ = select.select(running.keys(), [], [])
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        for fd in ready:
+            label, pid, buf = running[fd]
+            data = os.read(fd, 4096)
+            if data:
+                lines = (buf + data).split('\n')
+                for line in lines[:-1]:
+                    emit(label, line)
+                running[fd][2] = lines[-1]
+                continue
+
+            if buf:
+                emit(label, buf)
+            os.close(fd)
+            del running[fd]
+            _, retv = os.waitpid(pid, 0)
+            if os.WIFEXITED(retv):
+                status[label] = os.WEXITSTATUS(retv)
+            else:
+                status[label] = 128 + os.WTERMSIG(retv)
+
+    return status
@@ -7,8 +7,14 @@ Copyright: Copyright (C) 2012 Kel Modderman <kel@otaku42.de>
 License:   GPL-2
 """
 
+from configobj import ConfigObj
+from fll.locales import FllLocales, FllLocalesError
+
+import fll.cache
 import fnmatch
+import json
 import os
+import tempfile
 
 class PkgModError(Exception):
     """
@@ -17,6 +23,23 @@ class PkgModError(Exception):
     pass
 
 
+def stamp(path):
+    """Return the mtime and size of path, or None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+
+def fresh(stamps):
+    """Return True if no path of a dict of path -> stamp has changed."""
+    for path, value in stamps.iteritems():
+        if stamp(path) != value:
+            return False
+    return True
+
+
 class PkgMod(object):
     """
     A class for parsing package profile modules.
@@ -27,52 +50,54 @@ class PkgMod(object):
     architecture - (str)               Architecture codename
     config       - (dict)              The 'profile' section of a
                                        fll.config.Config object
-    locales      - (dict)              dict of locales to be considered when
-                                       selecting packages from apt's cache
+    locales      - (list)              list of locales to be considered when
+                                       selecting packages from apt's cache,
+                                       defaults to the 'locales' option of
+                                       config
     """
-    def __init__(self, aptlib=None, architecture=None, config={}, locales={}):
+    def __init__(self, aptlib=None, architecture=None, config={}, locales=[]):
         self.apt = aptlib
         self.arch = architecture
         self.config = config
-        self.locales = locales
+        self.locales = locales or config.get('locales', [])
+        self.locale_pkgs = {}
         self.pkgs = set()
         self.profiles = {}
         self.lists = {}
         self.debconf = {}
         self.postinst = {}
-
-        try:
-            self.locate_files(config['dir'])
-        except KeyError:
-            # this seems to be pointless?
-            self.modules = {}
+        self.dirs = {}
+        self.parsed = set()
 
         try:
             self.profile = config['name']
         except KeyError:
             self.profile = None
 
-        if self.profile != None and len(self.profiles.keys()) > 0:
-            self.pkgs.update(self.expand_profile())
+        if self.profile and config.get('dir'):
+            self.pkgs.update(self.cached_profile(config['dir']))
 
         try:
             self.pkgs.update(config['packages'])
         except KeyError:
             pass
 
+        if self.locales and self.apt is not None:
+            self.locale_pkgs = self.detect_locale_packages()
+            for pkgs in self.locale_pkgs.itervalues():
+                self.pkgs.update(pkgs)
+
     def locate_files(self, dirname):
         for path, dirs, files in os.walk(dirname):
-            for d in dirs:
-                if d.startswith('.'):
-                    dirs.remove(d)
-            
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            self.dirs[path] = stamp(path)
+
             for f in fnmatch.filter(files, '*.profile'):
                 profile = f.rsplit('.', 1)[0]
                 self.profiles[profile] = os.path.join(path, f)
 
             for f in fnmatch.filter(files, '*.list') + \
                      fnmatch.filter(files, '*.list.%s' % self.arch):
-                print f
                 self.lists[f] = os.path.join(path, f)
 
             for f in fnmatch.filter(files, '*.debconf'):
@@ -81,50 +106,140 @@ class PkgMod(object):
             for f in fnmatch.filter(files, '*.postinst'):
                 self.postinst[f] = os.path.join(path, f)
 
+    def cached_profile(self, dirname):
+        """Return the expanded package list of the profile. Expanded
+        profiles are cached per profile directory, together with the mtime
+        of each directory in it and the mtime and size of each file which
+        was parsed. A cached profile is reused while none of its files have
+        changed; a changed directory invalidates all profiles of the
+        directory, as included lists may have been added or removed."""
+        cache = self.config.get('cache', {})
+        if not cache or not cache['enable']:
+            self.locate_files(dirname)
+            if not self.profiles:
+                return []
+            return self.expand_profile()
+
+        fname = os.path.join(cache['dir'], '%s.json' %
+                             fll.cache.digest(os.path.realpath(dirname)))
+        key = '%s/%s' % (self.profile, self.arch)
+
+        record = None
+        try:
+            with open(fname) as fh:
+                record = json.load(fh)
+        except (IOError, ValueError):
+            pass
+
+        if record and fresh(record['dirs']):
+            entry = record['profiles'].get(key)
+            if entry and fresh(entry['files']):
+                print 'PROFILE %s cached' % key
+                return [str(pkg) for pkg in entry['pkgs']]
+        else:
+            record = {'dirs': {}, 'profiles': {}}
+
+        self.locate_files(dirname)
+        if not self.profiles:
+            return []
+        pkgs = self.expand_profile()
+
+        record['dirs'] = self.dirs
+        record['profiles'][key] = {
+            'files': dict([(f, stamp(f)) for f in self.parsed]),
+            'pkgs': pkgs,
+        }
+        # The cache directory is shared by builds running in parallel, each
+        # writes to a temporary file of its own.
+        tmp = None
+        try:
+            if not os.path.isdir(cache['dir']):
+                os.makedirs(cache['dir'])
+            fd, tmp = tempfile.mkstemp(dir=cache['dir'], prefix='.')
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(record, fh)
+            os.rename(tmp, fname)
+        except (IOError, OSError), e:
+            print 'PROFILE cache not written: %s' % e
+            if tmp and os.path.exists(tmp):
+                os.unlink(tmp)
+
+        return pkgs
+
     def expand_profile(self):
-        lists = []
-        pkgs = []
+        """Return the de-duplicated list of packages of the lists included
+        by the profile, in order of appearance."""
         if self.profile in self.profiles:
             fname = self.profiles[self.profile]
         else:
             raise PkgModError('unknown package profile: %s' % self.profile)
-        
-        fh = None
-        try:
-            fh = open(fname, 'r')
-            for line in fh.readlines():
-                if not line.startswith('#include '):
-                    continue
-                for l in line.split()[1:]:
-                    if l in self.lists:
-                        print l
-                        lists.append(self.lists[l])
-                    else:
-                        raise PkgModError('unknown package list: %s' % l)
-
-                    arch_l = '%s.%s' % (l, self.arch)
-                    if arch_l in self.lists:
-                        lists.append(self.lists[arch_l])
 
-                    # XXX: debconf + postinst
-        except:
-            pass
-        finally:
-            if fh:
-                fh.close()
-
-        for fname in lists:
-            fh = None
-            try:
-                fh = open(fname, 'r')
-                for line in fh.readlines():
-                    if not line:
+        self.parsed = set([fname])
+        pkgs = []
+        seen = set()
+        try:
+            with open(fname, 'r') as fh:
+                for line in fh:
+                    if not line.startswith('#include '):
                         continue
-                    pkgs.append(line.strip())
-            except:
-                pass
-            finally:
-                if fh:
-                    fh.close()
+                    # XXX: debconf + postinst
+                    for pkg in self.include(line.split()[1:]):
+                        if pkg not in seen:
+                            seen.add(pkg)
+                            pkgs.append(pkg)
+        except IOError, e:
+            raise PkgModError('failed to read package profile: %s' % e)
 
         return pkgs
+
+    def include(self, names):
+        """Yield the packages of the named lists and their architecture
+        specific counterparts. A list is only parsed once per profile."""
+        for name in names:
+            if name not in self.lists:
+                raise PkgModError('unknown package list: %s' % name)
+            fnames = [self.lists[name]]
+            arch_name = '%s.%s' % (name, self.arch)
+            if arch_name in self.lists:
+                fnames.append(self.lists[arch_name])
+
+            for fname in fnames:
+                if fname in self.parsed:
+                    continue
+                self.parsed.add(fname)
+                for pkg in self.parse_list(fname):
+                    yield pkg
+
+    def parse_list(self, fname):
+        """Yield the package names of a list, one per line, skipping blank
+        lines and comments. Lists may #include other lists."""
+        with open(fname, 'r') as fh:
+            for line in fh:
+                if line.startswith('#include '):
+                    for pkg in self.include(line.split()[1:]):
+                        yield pkg
+                    continue
+                pkg = line.split('#', 1)[0].strip()
+                if pkg:
+                    yield pkg
+
+    def detect_locale_packages(self):
+        """Return a dict which maps each of the locales to the locale
+        support packages for the selected packages, as determined by
+        fll.locales.FllLocales and the locales-pkg-map data file."""
+        if os.path.isfile('data/locales-pkg-map'):
+            fname = 'data/locales-pkg-map'
+        else:
+            fname = '/usr/share/fll/data/locales-pkg-map'
+
+        pkgmap = dict()
+        for pkg, prefixes in ConfigObj(fname, list_values=True).iteritems():
+            if isinstance(prefixes, basestring):
+                prefixes = [prefixes]
+            pkgmap[pkg] = [p for p in prefixes if p]
+
+        try:
+            locales = FllLocales(self.apt.cache, self.pkgs, pkgmap)
+            return locales.detect_locales_packages(self.locales)
+        except FllLocalesError, e:
+            raise PkgModError('invalid locale: %s' % e)
@@ -0,0 +1,137 @@
+"""
+This is the fll.report module, it records the wall time and resources used
+by each phase of a build and by each command it executes, and writes them
+to a machine readable report.
+
+Copyright: Copyright (C) 2026 The fll contributors
+License:   GPL-2
+"""
+
+from contextlib import contextmanager
+
+import json
+import resource
+import time
+
+
+def size_to_str(nbytes):
+    """Return a human readable string for a number of bytes."""
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if nbytes < 1000:
+            break
+        nbytes /= 1000.0
+    else:
+        unit = 'TB'
+    return '%.1f%s' % (nbytes, unit)
+
+
+class Report(object):
+    """
+    A class which records the resources used by build phases and commands.
+
+    Resource usage covers this process and all of its reaped children. Wall
+    time, cpu time, bytes downloaded by apt and bytes written to disk are
+    recorded as the difference over each phase or command. Max RSS is the
+    peak resident set size of this process or any child up to its end.
+
+    Options        Type   Description
+    --------------------------------------------------------------------------
+    label        - (str)  label of the report, eg. the architecture
+    """
+    def __init__(self, label=None):
+        self.label = label
+        self.phases = list()
+        self.commands = list()
+        self.downloaded = 0
+        self._start = self._sample()
+
+    def _sample(self):
+        rself = resource.getrusage(resource.RUSAGE_SELF)
+        rchildren = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {'wall': time.time(),
+                'cpu': rself.ru_utime + rself.ru_stime +
+                       rchildren.ru_utime + rchildren.ru_stime,
+                'maxrss': max(rself.ru_maxrss, rchildren.ru_maxrss) * 1024,
+                'written': (rself.ru_oublock + rchildren.ru_oublock) * 512,
+                'downloaded': self.downloaded}
+
+    def _delta(self, before):
+        after = self._sample()
+        delta = {'maxrss': after['maxrss']}
+        for key in ['wall', 'cpu', 'written', 'downloaded']:
+            delta[key] = after[key] - before[key]
+        return delta
+
+    @contextmanager
+    def phase(self, name):
+        """Record the resources used by a build phase."""
+        before = self._sample()
+        status = 'failed'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            entry = self._delta(before)
+            entry.update({'name': name, 'status': status})
+            self.phases.append(entry)
+
+    @contextmanager
+    def command(self, cmd):
+        """Record the resources used by a command."""
+        before = self._sample()
+        status = 'failed'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            entry = self._delta(before)
+            entry.update({'command': ' '.join(cmd), 'status': status})
+            self.commands.append(entry)
+
+    def dump(self):
+        """Return the report as a dict."""
+        total = self._delta(self._start)
+        total['name'] = 'total'
+        return {'label': self.label, 'phases': self.phases,
+                'commands': self.commands, 'total': total}
+
+    def write(self, filename):
+        """Write the report as JSON to filename."""
+        with open(filename, 'w') as fh:
+            json.dump(self.dump(), fh, indent=2, sort_keys=True)
+
+    def summary(self):
+        """Return a human readable table of the phases of the report."""
+        report = self.dump()
+        fmt = '%-12s %10s %10s %10s %10s %10s'
+        lines = [fmt % ('PHASE', 'WALL', 'CPU', 'MAXRSS', 'DOWNLOADED',
+                        'WRITTEN')]
+        for entry in report['phases'] + [report['total']]:
+            lines.append(fmt % (entry['name'],
+                                '%.1fs' % entry['wall'],
+                                '%.1fs' % entry['cpu'],
+                                size_to_str(entry['maxrss']),
+                                size_to_str(entry['downloaded']),
+                                size_to_str(entry['written'])))
+        return '\n'.join(lines)
+
+
+_report = Report()
+
+def start(label=None):
+    """Start a new report which phases and commands are recorded to."""
+    global _report
+    _report = Report(label)
+    return _report
+
+def phase(name):
+    """Record the resources used by a build phase in the current report."""
+    return _report.phase(name)
+
+def command(cmd):
+    """Record the resources used by a command in the current report."""
+    return _report.command(cmd)
+
+def downloaded(nbytes):
+    """Account for bytes downloaded in the current report."""
+    _report.downloaded += nbytes